@@ -5,8 +5,8 @@ if __name__ == '__main__':
     input_ply_file = 'path_to_ply_file'
     output_ply_file = 'path_to_output_file'
 
-    inlier_cloud, outlier_cloud = PreprocessorUtils.statistical_outlier_removal(input_ply_file
-                                                                                ,[10, 3])
+    inlier_cloud, outlier_cloud = PreprocessorUtils.statistical_outlier_removal(input_ply_file, [10, 3],
+                                                                                return_outliers=True)
 
     inlier_pcd = PlaygroundUtils.pyntcloud_to_open3d(inlier_cloud)
     outlier_pcd = PlaygroundUtils.pyntcloud_to_open3d(outlier_cloud)
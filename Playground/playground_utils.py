@@ -9,12 +9,7 @@ class PlaygroundUtils:
     @staticmethod
     def pyntcloud_to_open3d(file_or_cloud):
         cloud = PreprocessorUtils.read_point_cloud(file_or_cloud)
-        cloud_pts = cloud.points[['x', 'y', 'z', 'intensity']].values
-
-        xyz = cloud_pts[:, :3]
-        open3d_cloud = o3d.geometry.PointCloud()
-        open3d_cloud.points = o3d.utility.Vector3dVector(xyz)
-        return open3d_cloud
+        return cloud.to_open3d()
 
     @staticmethod
     def color_pcd(pcd, clr='r'):
@@ -1,12 +1,15 @@
-from geopy.distance import geodesic
+from Utils.geodesy_utils import GeodesyUtils
 from rosbags.highlevel import AnyReader
 from pathlib import Path
 import yaml
+import json
+import os
 
 
 class DistanceComputer:
-    def __init__(self, bag_path):
+    def __init__(self, bag_path, output_dir):
         self.bag_file = bag_path
+        self.main_dir = output_dir
 
         with open('Params/params.yaml', 'r') as parameters:
             try:
@@ -14,26 +17,71 @@ class DistanceComputer:
             except yaml.YAMLError as exc:
                 print(f"Error reading YAML file: {exc}")
 
+        with open('Config/settings.yaml', 'r') as settings:
+            try:
+                setts = yaml.safe_load(settings)
+            except yaml.YAMLError as exc:
+                print(f"Error reading YAML file: {exc}")
+
         # Load parameters
         self.gnss_topic = params['Topics']['gps_topic']
 
+        # Load output paths
+        self.distance_file = os.path.join(self.main_dir, setts['Extractor']['distance_file'])
+
+    @staticmethod
+    def track_distance(latitudes, longitudes):
+        # Total drive distance and the cumulative distance at every GNSS fix
+        total_distance, cumulative = GeodesyUtils.track_distance(latitudes, longitudes)
+        return total_distance, cumulative
+
+    def bag_signature(self):
+        stat = os.stat(self.bag_file)
+        return {
+            "bag_file": os.path.abspath(self.bag_file),
+            "bag_size": stat.st_size,
+            "bag_mtime": stat.st_mtime_ns
+        }
+
+    def write_summary(self, distance, cumulative):
+        summary = self.bag_signature()
+        summary.update({
+            "num_fixes": len(cumulative),
+            "distance": distance
+        })
+        os.makedirs(os.path.dirname(self.distance_file), exist_ok=True)
+        with open(self.distance_file, 'w') as f:
+            json.dump(summary, f, indent=4)
+
+    def load_summary(self):
+        # The sidecar is only trusted if it was written for this exact bag
+        if not os.path.isfile(self.distance_file):
+            return None
+        with open(self.distance_file, 'r') as f:
+            summary = json.load(f)
+        signature = self.bag_signature()
+        if any(summary.get(key) != value for key, value in signature.items()):
+            return None
+        return summary['distance']
+
     def compute_distance(self):
-        total_distance = 0.0
-        previous_coords = None
+        latitudes, longitudes = [], []
 
         with AnyReader([Path(self.bag_file)]) as reader:
             connections = [x for x in reader.connections if x.topic == self.gnss_topic]
 
             for connection, timestamp, rawdata in reader.messages(connections=connections):
                 msg = reader.deserialize(rawdata, connection.msgtype)
-                current_coords = (msg.latitude, msg.longitude)
-
-                if previous_coords is not None:
-                    distance = geodesic(previous_coords, current_coords).meters
-                    total_distance += distance
-
-                previous_coords = current_coords
+                latitudes.append(msg.latitude)
+                longitudes.append(msg.longitude)
 
+        total_distance, cumulative = DistanceComputer.track_distance(latitudes, longitudes)
+        self.write_summary(total_distance, cumulative)
         return total_distance
 
-
+    def get_distance(self):
+        distance = self.load_summary()
+        if distance is None:
+            print("No cached drive distance found for this bag, scanning GNSS messages...")
+            distance = self.compute_distance()
+        return distance
@@ -1,13 +1,14 @@
 import yaml
 import os
 from pathlib import Path
-from pyntcloud import PyntCloud
 from tqdm import tqdm
 from rosbags.highlevel import AnyReader
-import pandas as pd
 import json
-from Utils.ply_to_pcd_converter import PLYtoPCD
+from Utils.frame_store import FrameSink
+from Utils.async_writer import AsyncFrameWriter
+from Scripts.distance_computer import DistanceComputer
 import numpy as np
+from Utils.perf_report import PerfReport
 
 
 class Extractor:
@@ -29,6 +30,10 @@ class Extractor:
 
         # Load parameters
         self.save_as = params['Extractor']['save_as']
+        self.frames_per_chunk = params['Extractor']['frames_per_chunk']
+        self.pcd_data = params['Extractor']['pcd_data']
+        self.writer_workers = params['Extractor']['writer_workers']
+        self.writer_queue_size = params['Extractor']['writer_queue_size']
         self.gps_topic = params['Topics']['gps_topic']
         self.lidar_topic = params['Topics']['lidar_topic']
         self.topics_list = [self.gps_topic, self.lidar_topic]
@@ -41,10 +46,21 @@ class Extractor:
         self.frames_dir = os.path.join(self.main_dir, setts['Extractor']['frames_dir'])
         os.makedirs(self.frames_dir, exist_ok=True)
         self.gnss_file = os.path.join(self.main_dir, setts['Extractor']['gnss_file'])
+        self.dstComputer = DistanceComputer(self.bag_file, self.main_dir)
+        self.distance = None
+
+    @staticmethod
+    def decode_frame(payload):
+        data, height, width = payload
+        points_data = np.frombuffer(data, dtype=np.float32).reshape(
+            (height, width, 4))  # Assuming x, y, z, intensity
+        return points_data.reshape(-1, 4)
 
     def run(self):
         gps_ts, latitudes, longitudes, altitudes = [], [], [], []
-        with AnyReader([Path(self.bag_file)]) as reader:
+        sink = FrameSink(self.frames_dir, self.save_as, self.frames_per_chunk, self.pcd_data)
+        with AsyncFrameWriter(sink, Extractor.decode_frame, self.writer_workers, self.writer_queue_size) as writer, \
+                AnyReader([Path(self.bag_file)]) as reader:
             connections = [x for x in reader.connections if x.topic in self.topics_list]
             for connection, timestamp, rawdata in tqdm(reader.messages(connections=connections),
                                                        desc='Processing Bag...'):
@@ -52,27 +68,9 @@ class Extractor:
 
                 if topic_name == '/rslidar_points':
                     msg = reader.deserialize(rawdata, connection.msgtype)
-                    points_data = np.frombuffer(msg.data, dtype=np.float32).reshape(
-                        (msg.height, msg.width, 4))  # Assuming x, y, z, intensity
-
-                    pcd = points_data[:, :, :3]
-                    intensities = points_data[:, :, 3]
-                    flat_pcd = pcd.reshape(-1, 3)
-                    flat_intensities = intensities.reshape(-1, 1)
-
-                    # Save to PCD
-                    df = pd.DataFrame(data=np.hstack((flat_pcd, flat_intensities)),
-                                      columns=['x', 'y', 'z', 'intensity'])
-                    cloud = PyntCloud(df)
-                    ply_file = os.path.join(self.frames_dir, f"{timestamp}.ply")
-
-                    if self.save_as == 'pcd':
-                        pcd_file = os.path.join(self.frames_dir, f"{timestamp}.pcd")
-                        PLYtoPCD.ply_to_pcd(ply_file, pcd_file)
-                        os.remove(ply_file)
-
-                    elif self.save_as == 'ply':
-                        cloud.to_file(ply_file)
+                    # Decoding and writing happen on the writer threads, the bag loop only hands over buffers
+                    writer.submit(timestamp, (msg.data, msg.height, msg.width))
+                    PerfReport.count(frames=1, points=msg.height * msg.width)
 
                 elif topic_name == '/gnss':
                     msg = reader.deserialize(rawdata, connection.msgtype)
@@ -81,16 +79,21 @@ class Extractor:
                     longitudes.append(msg.longitude)
                     altitudes.append(msg.altitude)
 
-                # GPS data to JSON
-            gps_data = {
-                "timestamps": gps_ts,
-                "latitude": latitudes,
-                "longitude": longitudes,
-                "altitude": altitudes
-            }
+        # GPS data to JSON
+        gps_data = {
+            "timestamps": gps_ts,
+            "latitude": latitudes,
+            "longitude": longitudes,
+            "altitude": altitudes
+        }
+
+        with open(self.gnss_file, 'w') as f:
+            json.dump(gps_data, f, indent=4)
 
-            with open(self.gnss_file, 'w') as f:
-                json.dump(gps_data, f, indent=4)
+        # Drive distance from the same GNSS pass, cached for runs without the extractor
+        self.distance, cumulative = DistanceComputer.track_distance(latitudes, longitudes)
+        self.dstComputer.write_summary(self.distance, cumulative)
 
-            print(f"Lidar frames saved in directory: {self.frames_dir}")
-            print(f"GPS data saved at: {self.gnss_file}")
+        print(f"Lidar frames saved in directory: {self.frames_dir}")
+        print(f"GPS data saved at: {self.gnss_file}")
+        print(f"Drive distance summary saved at: {self.dstComputer.distance_file}")
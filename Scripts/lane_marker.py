@@ -3,6 +3,7 @@ from Utils.lane_marker_utils import LaneMarkerUtils
 import os
 from Utils.preprocessor_utils import PreprocessorUtils
 import json
+from Utils.perf_report import PerfReport
 
 
 class LaneMarker:
@@ -45,29 +46,38 @@ class LaneMarker:
         self.markings_file = os.path.join(self.main_dir, setts['LaneMarker']['clustered_markings'])
         self.geojson_file = os.path.join(self.main_dir, setts['LaneMarker']['geojson_path'])
 
-    def run(self):
+    def load_map(self):
         cloud = PreprocessorUtils.read_point_cloud(self.map_file_path)
-        points = cloud.points.values
-        intensity = points[:, 3]
+        PerfReport.count(points=len(cloud))
         if not self.use_manual_param:
-            self.intensity_filter = LaneMarkerUtils.intensity_filter(intensity, self.num_std_devs)
+            self.intensity_filter = LaneMarkerUtils.intensity_filter(cloud.intensity, self.num_std_devs)
             print(f"Using computed intensity bounds: {self.intensity_filter}")
-        if self.plot_histogram:
-            print(f"Rendering Intensity Histogram. This may take a while...")
-            LaneMarkerUtils.plot_intensity_histogram(intensity,
-                                                     self.intensity_filter,
-                                                     self.plot_file)
+        return cloud
+
+    def write_histogram(self, cloud):
+        print(f"Rendering Intensity Histogram. This may take a while...")
+        LaneMarkerUtils.plot_intensity_histogram(cloud.intensity,
+                                                 self.intensity_filter,
+                                                 self.plot_file)
+
+    def extract_markings(self, cloud):
         print("Applying intensity filter...")
-        inlier_intensity, _ = LaneMarkerUtils.apply_intensity_filter(self.map_file_path,
-                                                                     self.intensity_filter)
+        inlier_intensity, _ = LaneMarkerUtils.apply_intensity_filter(cloud, self.intensity_filter)
         print("Intensity based filtering completed")
         print("Applying DBSCAN clustering...")
         clusters_list, clusters_cloud, _ = LaneMarkerUtils.apply_clustering(inlier_intensity,
                                                                             self.eps, self.num_points,
                                                                             self.print_progress)
+        PerfReport.count(points=len(cloud), clusters=len(clusters_list))
         clusters_cloud.to_file(self.markings_file)
         print(f"Clustered points saved at: {self.markings_file}")
         hulls = LaneMarkerUtils.compute_hulls(clusters_list, self.alpha)
         print("Converting hulls to latlon")
         latlon_hulls = LaneMarkerUtils.convert_hulls_to_latlon(hulls, self.offset)
         LaneMarkerUtils.extract_geojson(latlon_hulls, self.geojson_file)
+
+    def run(self):
+        cloud = self.load_map()
+        if self.plot_histogram:
+            self.write_histogram(cloud)
+        self.extract_markings(cloud)
@@ -1,6 +1,12 @@
 import os
-import subprocess
+import time
 import yaml
+import numpy as np
+from tqdm import tqdm
+from kiss_icp.config import load_config
+from kiss_icp.kiss_icp import KissICP
+from Utils.frame_store import FrameSource
+from Utils.perf_report import PerfReport
 
 
 class RunKissICP:
@@ -21,8 +27,10 @@ class RunKissICP:
                 print(f"Error reading YAML file: {exc}")
 
         # Load parameters
-        self.max_range = str(params['LidarOdometry']['max_range'])
+        self.max_range = float(params['LidarOdometry']['max_range'])
         self.deskew = params['LidarOdometry']['deskew']
+        self.checkpoint_every = params['LidarOdometry']['checkpoint_every']
+        self.resume = params['LidarOdometry']['resume']
 
         # Load input paths
         if self.preprocessor_flag:
@@ -34,17 +42,125 @@ class RunKissICP:
         self.odometry = setts['LidarOdometry']['odometry']
         self.module_dir = os.path.join(self.main_dir, self.odometry)
         os.makedirs(self.module_dir, exist_ok=True)
+        self.poses_file = os.path.join(self.main_dir, setts['LidarOdometry']['poses_file'])
+        self.registration_times_file = os.path.join(self.main_dir, setts['LidarOdometry']['registration_times_file'])
+        self.checkpoint_file = os.path.join(self.main_dir, setts['LidarOdometry']['checkpoint_file'])
+        self.partial_poses_file = os.path.join(self.main_dir, setts['LidarOdometry']['partial_poses_file'])
 
-    def run(self):
-        cwd = os.getcwd()
-        command = ["kiss_icp_pipeline", self.frames_dir,
-                   "--max_range", self.max_range]
-        if self.deskew:
-            command.append("--deskew")
-
-        try:
-            os.chdir(self.module_dir)
-            subprocess.run(command)
-            os.chdir(cwd)
-        except Exception as e:
-            print(f"Error Running kiss_icp_pipeline: {e}")
+    def kiss_config(self):
+        # Same defaults kiss_icp_pipeline derives from --max_range and --deskew
+        config = load_config(None)
+        config.data.max_range = self.max_range
+        config.data.deskew = self.deskew
+        config.mapping.voxel_size = self.max_range / 100.0
+        if config.data.max_range < config.data.min_range:
+            config.data.min_range = 0.0
+        return config
+
+    def save_checkpoint(self, odometry, poses, registration_times, names, signature, num_frames):
+        # Written to a temporary file and renamed, a kill mid-write leaves the previous checkpoint intact
+        tmp_file = self.checkpoint_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, poses=poses, registration_times=registration_times,
+                     local_map=odometry.local_map.point_cloud(), num_frames=num_frames,
+                     names=np.array(names if names is not None else [], dtype=str), signature=signature,
+                     max_range=self.max_range, deskew=self.deskew)
+        os.replace(tmp_file, self.checkpoint_file)
+
+    def restore_checkpoint(self, odometry, poses, registration_times, names, signature):
+        if not os.path.isfile(self.checkpoint_file):
+            return 0
+        checkpoint = np.load(self.checkpoint_file)
+        # Frames written again since, e.g. preprocessed with other filters, keep their names but not their signature
+        if (int(checkpoint['num_frames']) != len(poses) or
+                float(checkpoint['max_range']) != self.max_range or bool(checkpoint['deskew']) != self.deskew or
+                (names is not None and checkpoint['names'].tolist() != list(names)) or
+                'signature' not in checkpoint.files or str(checkpoint['signature']) != signature):
+            print(f"\033[93mOdometry checkpoint {self.checkpoint_file} does not match these frames, starting over\033[0m")
+            return 0
+
+        done = len(checkpoint['poses'])
+        poses[:done] = checkpoint['poses']
+        registration_times[:done] = checkpoint['registration_times']
+
+        # The adaptive threshold has no accessor, its state is rebuilt by replaying the model
+        # deviations exactly as register_frame computed them from the poses
+        last_pose, last_delta = np.eye(4), np.eye(4)
+        for pose in poses[:done]:
+            initial_guess = last_pose @ last_delta
+            odometry.adaptive_threshold.update_model_deviation(np.linalg.inv(initial_guess) @ pose)
+            last_delta = np.linalg.inv(last_pose) @ pose
+            last_pose = pose
+        odometry.last_pose = last_pose
+        odometry.last_delta = last_delta
+        odometry.local_map.add_points(checkpoint['local_map'])
+
+        print(f"Resuming odometry from checkpoint at frame {done}/{len(poses)}")
+        return done
+
+    def register_frames(self, frames):
+        # frames: anything indexable with (n, >=3) point arrays, a FrameSource or in-memory frames
+        names = getattr(frames, 'names', None)
+        signature = frames.signature() if hasattr(frames, 'signature') else ''
+        odometry = KissICP(self.kiss_config())
+        poses = np.zeros((len(frames), 4, 4))
+        registration_times = np.zeros(len(frames))
+        # The frames carry no per-point timestamps, deskewing then falls back to a no-op like the pipeline
+        timestamps = np.array([])
+
+        done = self.restore_checkpoint(odometry, poses, registration_times, names, signature) if self.resume else 0
+        checkpointed = done
+        registering = False
+
+        # Raw float64 4x4 poses appended as frames finish, np.fromfile(...).reshape(-1, 4, 4) reads them mid-run
+        with open(self.partial_poses_file, 'wb') as partial_poses:
+            partial_poses.write(poses[:done].tobytes())
+            try:
+                for idx in tqdm(range(done, len(frames)), desc='Registering Frames', initial=done,
+                                total=len(frames)):
+                    xyz = np.asarray(frames[idx])[:, :3].astype(np.float64)
+                    xyz = xyz[np.isfinite(xyz).all(axis=1)]
+
+                    registering = True
+                    start_time = time.perf_counter()
+                    odometry.register_frame(xyz, timestamps)
+                    registration_times[idx] = time.perf_counter() - start_time
+                    registering = False
+                    poses[idx] = odometry.last_pose
+                    PerfReport.count(frames=1, points=len(xyz))
+                    done = idx + 1
+
+                    partial_poses.write(poses[idx].tobytes())
+                    partial_poses.flush()
+                    if self.checkpoint_every and done % self.checkpoint_every == 0:
+                        self.save_checkpoint(odometry, poses[:done], registration_times[:done], names, signature,
+                                             len(frames))
+                        checkpointed = done
+            except BaseException:
+                # Keep the frames registered since the last checkpoint, unless the failure
+                # happened inside register_frame and may have left its state half updated
+                if self.checkpoint_every and not registering and done > checkpointed:
+                    self.save_checkpoint(odometry, poses[:done], registration_times[:done], names, signature,
+                                         len(frames))
+                    print(f"Odometry checkpoint saved at frame {done}/{len(frames)}")
+                raise
+
+        return poses, registration_times
+
+    def run(self, frames=None):
+        if frames is None:
+            frames = FrameSource(self.frames_dir)
+        poses, registration_times = self.register_frames(frames)
+
+        np.save(self.poses_file, poses)
+        print(f"Odometry poses saved at {self.poses_file}")
+        np.save(self.registration_times_file, registration_times)
+        # The run is complete, a rerun should start from scratch
+        for file in (self.checkpoint_file, self.partial_poses_file):
+            if os.path.isfile(file):
+                os.remove(file)
+        if len(registration_times):
+            print(f"Registration time per frame: mean {registration_times.mean() * 1000:.1f} ms, "
+                  f"median {np.median(registration_times) * 1000:.1f} ms, "
+                  f"max {registration_times.max() * 1000:.1f} ms")
+        return poses
@@ -1,12 +1,10 @@
 import yaml
 import os
+import json
 from Utils.trajectory_transformation_utils import TrajectoryTransformerUtils
-from Utils.map_generator_utils import MapGenratorUtils
-import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib.colors import Normalize
-from pyntcloud import PyntCloud
-import numpy as np
+from Utils.map_engine import MapEngine, MapSink, GroundSink, ColoredSink, StatsSink
+from Utils.map_tiles import MapTiles
+from Utils.filter_chain import FilterChain
 
 
 class MapGenerator:
@@ -34,6 +32,14 @@ class MapGenerator:
         self.distance_threshold = params["MapGenerator"]["distance_threshold"]
         self.ransac_n = params["MapGenerator"]["ransac_n"]
         self.num_iters = params["MapGenerator"]["num_iters"]
+        self.ground_filters = params["MapGenerator"]["ground_filters"]
+        self.voxel_downsample = params["MapGenerator"]["voxel_downsample"]
+        self.voxel_leaf_size = params["MapGenerator"]["voxel_leaf_size"]
+        self.voxel_reduction = params["MapGenerator"]["voxel_reduction"]
+        self.map_stats = params["MapGenerator"]["map_stats"]
+        self.workers = params["MapGenerator"]["workers"]
+        self.tiles = params["MapGenerator"]["tiles"]
+        self.tile_size = params["MapGenerator"]["tile_size"]
 
         # Set input paths
         if self.preprocessor_flag:
@@ -42,6 +48,7 @@ class MapGenerator:
             self.frames_dir = os.path.join(self.main_dir, setts['Extractor']['frames_dir'])
 
         self.poses_file = os.path.join(self.main_dir, setts['TrajectoryTransformer']['tf_poses_file'])
+        self.offset_file = os.path.join(self.main_dir, setts['TrajectoryTransformer']['offset_file'])
 
         # Set output paths
         self.module_dir = os.path.join(self.main_dir, setts['MapGenerator']['map'])
@@ -51,38 +58,55 @@ class MapGenerator:
             self.colored_map_file = os.path.join(self.main_dir, setts['MapGenerator']['colored_map_file'])
         if self.ground_map:
             self.ground_map_file = os.path.join(self.main_dir, setts["MapGenerator"]['ground_map_file'])
-
-    def run(self):
+        if self.map_stats:
+            self.stats_file = os.path.join(self.main_dir, setts["MapGenerator"]['stats_file'])
+        if self.tiles:
+            self.map_tiles_dir = os.path.join(self.main_dir, setts["MapGenerator"]['map_tiles_dir'])
+            self.ground_tiles_dir = os.path.join(self.main_dir, setts["MapGenerator"]['ground_tiles_dir'])
+
+    def ground_filter_stages(self):
+        # Ground candidates for RANSAC: nan -> radial, followed by any ground_filters from params.yaml
+        stages = [{'type': 'nan'}]
+        if self.apply_radial_filter:
+            stages.append({'type': 'radial', 'radius': self.radial_threshold})
+        return stages + list(self.ground_filters or [])
+
+    def build_maps(self):
+        # One pass over the frames feeds every requested map product
         poses, translations = TrajectoryTransformerUtils.load_states(self.poses_file)
-        transformed_map = MapGenratorUtils.generate_map(poses, self.frames_dir)
+        engine = MapEngine(poses, self.frames_dir, self.workers)
+        followers = [ColoredSink(self.colored_map_file)] if self.colored_map else []
+        voxel_size = self.voxel_leaf_size if self.voxel_downsample else None
+        engine.add_sink(MapSink(self.map_file, voxel_size, self.voxel_reduction, followers))
+        if self.ground_map:
+            engine.add_sink(GroundSink(self.ground_map_file, FilterChain.from_config(self.ground_filter_stages()),
+                                       self.distance_threshold, self.ransac_n, self.num_iters,
+                                       voxel_size, self.voxel_reduction))
+        if self.map_stats:
+            engine.add_sink(StatsSink(self.stats_file))
+        engine.run()
 
-        cloud = PyntCloud(pd.DataFrame(transformed_map, columns=['x', 'y', 'z', 'intensity']))
-        cloud.to_file(self.map_file)
         print(f"Map file saved to {self.map_file}")
-
         if self.ground_map:
-            ground_map = MapGenratorUtils.generate_ground_map(poses, self.frames_dir,
-                                                              self.radial_threshold,
-                                                              self.distance_threshold,
-                                                              self.ransac_n, self.num_iters,
-                                                              self.apply_radial_filter)
-
-            ground_cloud = PyntCloud(pd.DataFrame(ground_map, columns=['x', 'y', 'z', 'intensity']))
-            ground_cloud.to_file(self.ground_map_file)
             print(f"Ground Map file saved to {self.ground_map_file}")
-
         if self.colored_map:
-            z_values = transformed_map[:, 2]
-
-            norm = Normalize(vmin=np.min(z_values),
-                             vmax=np.max(z_values))
-
-            colors = plt.cm.nipy_spectral(norm(z_values))[:, :3]
-            data = np.hstack((transformed_map[:, :3], colors))
-            columns = ["x", "y", "z", "red", "green", "blue"]
-
-            # Create a DataFrame and a new PyntCloud for the colored map
-            colored_cloud = PyntCloud(pd.DataFrame(data, columns=columns))
-
-            colored_cloud.to_file(self.colored_map_file)
             print(f"Colored Map file saved to {self.colored_map_file}")
+        if self.map_stats:
+            print(f"Map statistics saved to {self.stats_file}")
+
+    def build_tiles(self):
+        # Tiles keep the conversion offset in their index, so they can be queried in lat/lon too
+        offset = None
+        if os.path.exists(self.offset_file):
+            with open(self.offset_file, 'r') as file:
+                offset = json.load(file)
+        MapTiles.write(self.map_file, self.map_tiles_dir, self.tile_size, offset)
+        print(f"Map tiles saved to {self.map_tiles_dir}")
+        if self.ground_map:
+            MapTiles.write(self.ground_map_file, self.ground_tiles_dir, self.tile_size, offset)
+            print(f"Ground Map tiles saved to {self.ground_tiles_dir}")
+
+    def run(self):
+        self.build_maps()
+        if self.tiles:
+            self.build_tiles()
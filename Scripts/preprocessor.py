@@ -1,10 +1,22 @@
 from Utils.preprocessor_utils import PreprocessorUtils
+from Utils.filter_chain import FilterChain
+from Utils.frame_store import FrameSource, FrameSink
+from Utils.async_writer import AsyncFrameWriter
 import yaml
 import os
+import multiprocessing
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
+from Utils.perf_report import PerfReport
 
 
 class Preprocessor:
+    # Per-process (preprocessor, frame source) pair, set up once in every pool worker. Workers are
+    # spawned rather than forked, the writer threads and the launcher's other tasks are running
+    worker_context = None
+
     def __init__(self, output_dir, distance):
         self.main_dir = output_dir
         self.distance = distance
@@ -22,6 +34,12 @@ class Preprocessor:
                 print(f"Error reading YAML file: {exc}")
 
         # Load parameters
+        self.save_as = params['Extractor']['save_as']
+        self.frames_per_chunk = params['Extractor']['frames_per_chunk']
+        self.pcd_data = params['Extractor']['pcd_data']
+        self.workers = params['Preprocessor']['workers'] or os.cpu_count()
+        self.writer_workers = params['Preprocessor']['writer_workers']
+        self.writer_queue_size = params['Preprocessor']['writer_queue_size']
         self.distance_threshold = params['Preprocessor']['drive_distance_thresh']
         self.basic_preprocessing = params['Preprocessor']['basic_preprocessing']
         self.advanced_preprocessing = params['Preprocessor']['advanced_preprocessing']
@@ -36,7 +54,19 @@ class Preprocessor:
                 self.advanced_preprocessing = True
         if self.advanced_preprocessing:
             self.SOR = [params['Preprocessor']['k_nbs'], params['Preprocessor']['z_thresh']]
+            self.sor_mode = params['Preprocessor']['sor_mode']
+            self.sor_voxel_size = params['Preprocessor']['sor_voxel_size']
+            self.sor_workers = params['Preprocessor']['sor_workers']
+            if self.sor_workers == -1 and self.workers > 1:
+                # Share the cores between pool processes instead of oversubscribing them
+                self.sor_workers = max(1, os.cpu_count() // self.workers)
             self.z_filter = params['Preprocessor']['z_filter']
+        self.extra_filters = params['Preprocessor']['extra_filters']
+        self.report_drop_counts = params['Preprocessor']['report_drop_counts']
+        self.voxel_downsample = params['Preprocessor']['voxel_downsample']
+        self.voxel_leaf_size = params['Preprocessor']['voxel_leaf_size']
+        self.voxel_reduction = params['Preprocessor']['voxel_reduction']
+        self.filter_chain = FilterChain.from_config(self.filter_stages(), self.report_drop_counts)
 
         # Load input paths
         self.input_frames = os.path.join(self.main_dir, setts['Extractor']['frames_dir'])
@@ -49,32 +79,86 @@ class Preprocessor:
         self.frames_dir = os.path.join(self.main_dir, setts['Preprocessor']['frames_dir'])
         os.makedirs(self.frames_dir, exist_ok=True)
 
-    def apply_basic_preprocessing(self):
-        sorted_frames = sorted(
-            [os.path.join(self.input_frames, frame) for frame in os.listdir(self.input_frames) if frame.endswith(".ply")])
-        for file in tqdm(sorted_frames, desc='Basic Preprocessing', total=len(sorted_frames)):
-            name = os.path.splitext(os.path.basename(file))[0]
-            processed_file = os.path.join(self.frames_dir, name + '.ply')
-            clean_cloud = PreprocessorUtils.remove_nans(file)
-            filtered_cloud, _ = PreprocessorUtils.remove_ego(clean_cloud, self.road_value_z)
-            filtered_cloud.to_file(processed_file)
-
-        print(f"Basic Preprocessing Completed! Frames dumped at {self.frames_dir}")
-
-    def apply_advanced_preprocessing(self):
-        sorted_frames = sorted(
-            [os.path.join(self.frames_dir, frame) for frame in os.listdir(self.frames_dir) if frame.endswith(".ply")])
-
-        for file in tqdm(sorted_frames, desc='Advanced Preprocessing', total=len(sorted_frames)):
-            filtered_cloud, _ = PreprocessorUtils.statistical_outlier_removal(file, self.SOR)
-            filtered_cloud, _ = PreprocessorUtils.z_filter(filtered_cloud, self.z_filter)
-
-            filtered_cloud.to_file(file)
-
-        print(f"Advanced Preprocessing Completed! Frames dumped at {self.frames_dir}")
-
-    def run(self):
+    def filter_stages(self):
+        # nan -> ego -> sor -> z_range, followed by any extra_filters from params.yaml
+        stages = [{'type': 'nan'}]
         if self.basic_preprocessing:
-            self.apply_basic_preprocessing()
+            stages.append({'type': 'ego', 'pog_z': self.road_value_z})
         if self.advanced_preprocessing:
-            self.apply_advanced_preprocessing()
+            stages.append({'type': 'sor', 'k_nbs': self.SOR[0], 'z_thresh': self.SOR[1], 'mode': self.sor_mode,
+                           'voxel_size': self.sor_voxel_size, 'workers': self.sor_workers})
+            stages.append({'type': 'z_range', 'range': self.z_filter})
+        return stages + list(self.extra_filters or [])
+
+    def preprocess_frame(self, points):
+        # Masks are ANDed on the in-memory frame, survivors are gathered only before SOR and once at the end
+        cloud, _ = self.filter_chain.apply(points)
+        if self.voxel_downsample:
+            cloud = PreprocessorUtils.voxel_downsample(cloud, self.voxel_leaf_size, self.voxel_reduction)
+        return cloud.points, self.filter_chain.last_drop_counts
+
+    @staticmethod
+    def init_worker(preprocessor, source):
+        Preprocessor.worker_context = (preprocessor, source)
+
+    @staticmethod
+    def process_index(idx):
+        # Errors are returned rather than raised so one bad frame does not tear down the pool
+        preprocessor, source = Preprocessor.worker_context
+        try:
+            points, drop_counts = preprocessor.preprocess_frame(source.read_frame(idx))
+            return idx, points, drop_counts, None
+        except Exception as e:
+            return idx, None, None, f"{type(e).__name__}: {e}"
+
+    def process_frames(self, source):
+        # Yields (idx, points, drop_counts, error) in frame order, the pool only ever holds a bounded
+        # window of frames in flight so results cannot pile up ahead of the writer
+        if self.workers <= 1:
+            Preprocessor.init_worker(self, source)
+            for idx in range(len(source)):
+                yield Preprocessor.process_index(idx)
+            return
+
+        window = self.workers * 4
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=Preprocessor.init_worker, initargs=(self, source)) as executor:
+            pending = deque()
+            for idx in range(len(source)):
+                pending.append(executor.submit(PerfReport.call_in_worker, Preprocessor.process_index, idx))
+                if len(pending) >= window:
+                    yield PerfReport.worker_result(pending.popleft())
+            while pending:
+                yield PerfReport.worker_result(pending.popleft())
+
+    def apply_preprocessing(self):
+        source = FrameSource(self.input_frames)
+        sink = FrameSink(self.frames_dir, self.save_as, self.frames_per_chunk, self.pcd_data)
+        errors = []
+        total_drop_counts = np.zeros(len(self.filter_chain), dtype=np.int64)
+        with AsyncFrameWriter(sink, workers=self.writer_workers, queue_size=self.writer_queue_size) as writer:
+            for idx, points, drop_counts, error in tqdm(self.process_frames(source), desc='Preprocessing',
+                                                        total=len(source)):
+                if error is not None:
+                    errors.append((source.names[idx], error))
+                    continue
+                if drop_counts is not None:
+                    total_drop_counts += drop_counts
+                writer.submit(source.names[idx], points)
+                PerfReport.count(frames=1, points=len(points))
+
+        if self.report_drop_counts:
+            self.filter_chain.print_drop_counts(total_drop_counts)
+
+        if errors:
+            print(f"\033[93m{len(errors)} of {len(source)} frames failed preprocessing and were skipped:\033[0m")
+            for name, error in errors[:10]:
+                print(f"  {name}: {error}")
+            if len(errors) == len(source):
+                raise RuntimeError("Preprocessing failed for every frame")
+
+        print(f"Preprocessing Completed! Frames dumped at {self.frames_dir}")
+
+    def run(self):
+        if self.basic_preprocessing or self.advanced_preprocessing:
+            self.apply_preprocessing()
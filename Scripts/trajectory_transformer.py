@@ -1,4 +1,5 @@
 from Utils.trajectory_transformation_utils import TrajectoryTransformerUtils
+from Utils.pose_utils import PoseUtils
 import yaml
 import os
 import numpy as np
@@ -6,7 +7,7 @@ import json
 
 
 class TrajectoryTransformer:
-    def __init__(self, output_dir):
+    def __init__(self, output_dir, poses=None):
         self.main_dir = output_dir
 
         with open('Params/params.yaml', 'r') as parameters:
@@ -28,6 +29,7 @@ class TrajectoryTransformer:
         self.manual_heading = params['TrajectoryTransformer']['manual_heading']
         self.use_manual_georef = params['TrajectoryTransformer']['use_manual_georef']
         self.georef_start = params['TrajectoryTransformer']['georef_start']
+        self.plot_point_budget = params['TrajectoryTransformer']['plot_point_budget']
 
         # Load output paths
         self.trajectory_transformed = setts['TrajectoryTransformer']['transformed_trajectory']
@@ -41,14 +43,13 @@ class TrajectoryTransformer:
 
         # Load input paths
         self.gnss_file = os.path.join(self.main_dir, setts['Extractor']['gnss_file'])
-        self.latest_dir = os.path.join(self.main_dir, setts['LidarOdometry']['latest_dir'])
-        for file in os.listdir(self.latest_dir):
-            if file.endswith('.npy'):
-                self.poses_file = os.path.join(self.latest_dir, file)
+        self.poses_file = os.path.join(self.main_dir, setts['LidarOdometry']['poses_file'])
 
         self.GPS_global = TrajectoryTransformerUtils.read_gps(self.gnss_file)
         self.GPS_local = TrajectoryTransformerUtils.convert_global_to_local(self.GPS_global)
-        self.ODOM_poses, self.ODOM_translations = TrajectoryTransformerUtils.load_states(self.poses_file)
+        # Poses handed over by the odometry stage, otherwise the ones it saved on an earlier run
+        self.ODOM_poses, self.ODOM_translations = TrajectoryTransformerUtils.load_states(
+            self.poses_file if poses is None else poses)
 
     def decide_georeferencing(self):
         if self.use_manual_georef:
@@ -72,21 +73,11 @@ class TrajectoryTransformer:
             return R4
 
     def apply_transformation(self):
-        TF_POSES = []
-        TF_translations = []
         CONV_offset = self.decide_georeferencing()
         R4 = self.decide_rotation()
-        POSES_copy = np.copy(self.ODOM_poses)
         # Applying Rotation
-        for idx in range(len(POSES_copy)):
-            pose = POSES_copy[idx]
-            rotated_pose = np.dot(R4, pose)
-            translation = rotated_pose[:3, 3]
-            TF_POSES.append(rotated_pose)
-            TF_translations.append(translation)
-
-        TF_POSES = np.array(TF_POSES)
-        TF_translations = np.array(TF_translations)
+        TF_POSES = PoseUtils.compose(R4, self.ODOM_poses)
+        TF_translations = PoseUtils.translations(TF_POSES)
 
         # Applying Translation
         TF_global = TrajectoryTransformerUtils.convert_local_to_global(TF_translations, CONV_offset)
@@ -97,13 +88,9 @@ class TrajectoryTransformer:
 
         return TF_POSES, set1, set2, CONV_offset
 
-    def write_results(self, TF_POSES, set1, set2, conv_offset):
+    def write_poses(self, TF_POSES, conv_offset):
         np.save(self.tf_poses_file, TF_POSES)
         print(f"Poses saved at {self.tf_poses_file}")
-        TrajectoryTransformerUtils.plot(self.org_plot_file, set1)
-        print(f"Raw plots saved at {self.org_plot_file}")
-        TrajectoryTransformerUtils.plot(self.tf_plot_file, set2)
-        print(f"Transformed plots saved at {self.tf_plot_file}")
         json_struct = {
             'utm_coords': conv_offset[0].tolist(),
             'zone_number': conv_offset[1],
@@ -113,8 +100,16 @@ class TrajectoryTransformer:
             json.dump(json_struct, file, indent=4)
         print(f"Offset file saved at: {self.offset_file}")
 
+    def write_plots(self, set1, set2):
+        TrajectoryTransformerUtils.plot(self.org_plot_file, set1, self.plot_point_budget)
+        print(f"Raw plots saved at {self.org_plot_file}")
+        TrajectoryTransformerUtils.plot(self.tf_plot_file, set2, self.plot_point_budget)
+        print(f"Transformed plots saved at {self.tf_plot_file}")
+
+    def write_results(self, TF_POSES, set1, set2, conv_offset):
+        self.write_poses(TF_POSES, conv_offset)
+        self.write_plots(set1, set2)
+
     def run(self):
         TF_POSES, set1, set2, CONV_offset = self.apply_transformation()
         self.write_results(TF_POSES, set1, set2, CONV_offset)
-
-
@@ -0,0 +1,73 @@
+import queue
+import threading
+
+
+class AsyncFrameWriter:
+    # Bounded producer/consumer pipeline in front of a FrameSink. submit() blocks once
+    # queue_size jobs are pending, so the producer never runs ahead of the disk by more than that.
+    # Frames are encoded and written on the worker threads; sinks that need ordered appends
+    # (chunked stores) are written in submission order, per-scan files are written as they come.
+    def __init__(self, sink, encode=None, workers=4, queue_size=32):
+        self.sink = sink
+        self.encode = encode
+        self.ordered = sink.ordered
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.condition = threading.Condition()
+        self.submitted = 0
+        self.next_write = 0
+        self.error = None
+
+        self.threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(max(1, workers))]
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+            return
+        # The producer failed, its exception is the one to report and not a writer error it caused
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def submit(self, name, payload):
+        if self.error is not None:
+            raise self.error
+        self.jobs.put((self.submitted, name, payload))
+        self.submitted += 1
+
+    def _worker(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            seq, name, payload = job
+            try:
+                points = self.encode(payload) if self.encode is not None else payload
+                if self.ordered:
+                    with self.condition:
+                        self.condition.wait_for(lambda: self.next_write == seq or self.error is not None)
+                        if self.error is None:
+                            self.sink.write(name, points)
+                        self.next_write += 1
+                        self.condition.notify_all()
+                else:
+                    self.sink.write(name, points)
+            except Exception as e:
+                with self.condition:
+                    if self.error is None:
+                        self.error = e
+                    self.condition.notify_all()
+
+    def close(self):
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.sink.close()
+        if self.error is not None:
+            raise self.error
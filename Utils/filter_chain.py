@@ -0,0 +1,94 @@
+import numpy as np
+from Utils.preprocessor_utils import PreprocessorUtils
+from Utils.perf_report import PerfReport
+
+# Stage type -> (mask function of (cloud, stage config), needs a compact cloud)
+# Plain stages are evaluated on the cloud as it is and only ANDed into the running mask,
+# gather stages (SOR) depend on which points survived, so the survivors are gathered first
+STAGES = {
+    'nan': (lambda cloud, cfg: PreprocessorUtils.nan_mask(cloud), False),
+    'ego': (lambda cloud, cfg: PreprocessorUtils.ego_mask(cloud, cfg.get('pog_z', -2.9)), False),
+    'box': (lambda cloud, cfg: PreprocessorUtils.box_mask(cloud, cfg['min'], cfg['max'],
+                                                          cfg.get('keep', 'outside') == 'inside'), False),
+    'z_range': (lambda cloud, cfg: PreprocessorUtils.z_mask(cloud, cfg['range']), False),
+    'radial': (lambda cloud, cfg: PreprocessorUtils.radial_mask(cloud, cfg['radius']), False),
+    'intensity': (lambda cloud, cfg: PreprocessorUtils.intensity_mask(cloud, cfg['range']), False),
+    'sor': (lambda cloud, cfg: PreprocessorUtils.sor_mask(cloud, [cfg['k_nbs'], cfg['z_thresh']],
+                                                          cfg.get('workers', 1), cfg.get('mode', 'exact'),
+                                                          cfg.get('voxel_size', 0.2)), True),
+}
+
+
+class FilterChain:
+    def __init__(self, stages, report_drop_counts=False):
+        for stage in stages:
+            if stage['type'] not in STAGES:
+                raise ValueError(f"Unknown filter stage: {stage['type']}")
+        self.stages = stages
+        self.report_drop_counts = report_drop_counts
+        # Points removed by every stage during the last apply, left at None unless reporting
+        self.last_drop_counts = None
+
+    @staticmethod
+    def from_config(config, report_drop_counts=False):
+        # config: list of {'type': <stage>, **stage parameters} as written in params.yaml
+        return FilterChain([dict(stage) for stage in config or []], report_drop_counts)
+
+    def __len__(self):
+        return len(self.stages)
+
+    def evaluate(self, cloud):
+        # (cloud, mask, alive): the last gathered cloud, the mask of its survivors (None without
+        # stages) and the indices into the input of the points that cloud holds (None if ungathered)
+        mask = None
+        alive = None
+        drop_counts = np.zeros(len(self.stages), dtype=np.int64) if self.report_drop_counts else None
+
+        for i, stage in enumerate(self.stages):
+            mask_fn, needs_gather = STAGES[stage['type']]
+            if needs_gather and mask is not None:
+                survivors = np.flatnonzero(mask)
+                cloud = cloud.select(survivors)
+                alive = survivors if alive is None else alive[survivors]
+                mask = None
+
+            stage_mask = mask_fn(cloud, stage)
+            if self.report_drop_counts:
+                dropped = ~stage_mask if mask is None else mask & ~stage_mask
+                drop_counts[i] = np.count_nonzero(dropped)
+            mask = stage_mask if mask is None else mask & stage_mask
+        self.last_drop_counts = drop_counts
+        return cloud, mask, alive
+
+    @PerfReport.kernel('FilterChain.apply')
+    def apply(self, file, return_outliers=False):
+        source = PreprocessorUtils.read_point_cloud(file)
+        cloud, mask, alive = self.evaluate(source)
+
+        if mask is None:
+            return cloud, (source[:0] if return_outliers else None)
+
+        survivors = np.flatnonzero(mask)
+        inliers = cloud.select(survivors)
+        outliers = None
+        if return_outliers:
+            keep = np.zeros(len(source), dtype=bool)
+            keep[survivors if alive is None else alive[survivors]] = True
+            outliers = source.select(~keep)
+        return inliers, outliers
+
+    @PerfReport.kernel('FilterChain.indices')
+    def indices(self, file):
+        # Indices into the input of the points that pass every stage, for picking them out of
+        # another array aligned with it
+        source = PreprocessorUtils.read_point_cloud(file)
+        cloud, mask, alive = self.evaluate(source)
+        if mask is None:
+            return np.arange(len(cloud))
+        survivors = np.flatnonzero(mask)
+        return survivors if alive is None else alive[survivors]
+
+    def print_drop_counts(self, drop_counts):
+        print(f"Filter chain dropped {int(np.sum(drop_counts))} points:")
+        for stage, count in zip(self.stages, drop_counts):
+            print(f"  {stage['type']:<10} {int(count)}")
@@ -0,0 +1,175 @@
+import os
+import json
+import hashlib
+import numpy as np
+from Utils.point_cloud import PointCloud
+from Utils.pcd_utils import PCDUtils
+from Utils.perf_report import PerfReport
+
+INDEX_FILE = 'index.npy'
+CHUNK_PREFIX = 'chunk_'
+INDEX_DTYPE = np.dtype([('name', 'U32'), ('chunk', np.int32), ('offset', np.int64), ('count', np.int64)])
+
+
+class FrameStoreWriter:
+    # Chunk layout: every frame is stored as 4 contiguous float32 columns (x, y, z, intensity)
+    # appended to the current chunk file. index.npy maps each frame to (chunk, byte offset, count).
+    def __init__(self, store_dir, frames_per_chunk=500):
+        self.store_dir = store_dir
+        self.frames_per_chunk = frames_per_chunk
+        os.makedirs(self.store_dir, exist_ok=True)
+        FrameStore.clear(self.store_dir)
+
+        self.entries = []
+        self.chunk_id = -1
+        self.chunk_file = None
+        self.chunk_offset = 0
+
+    def _next_chunk(self):
+        if self.chunk_file is not None:
+            self.chunk_file.close()
+        self.chunk_id += 1
+        self.chunk_file = open(FrameStore.chunk_path(self.store_dir, self.chunk_id), 'wb')
+        self.chunk_offset = 0
+
+    @PerfReport.kernel('FrameStoreWriter.append')
+    def append(self, name, points):
+        if len(self.entries) % self.frames_per_chunk == 0:
+            self._next_chunk()
+        columns = np.ascontiguousarray(np.asarray(points, dtype=np.float32)[:, :4].T)
+        self.chunk_file.write(columns.tobytes())
+        self.entries.append((str(name), self.chunk_id, self.chunk_offset, columns.shape[1]))
+        self.chunk_offset += columns.nbytes
+
+    def close(self):
+        if self.chunk_file is not None:
+            self.chunk_file.close()
+            self.chunk_file = None
+        index = np.array(self.entries, dtype=INDEX_DTYPE)
+        np.save(os.path.join(self.store_dir, INDEX_FILE), index)
+
+
+class FrameStore:
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.index = np.load(os.path.join(self.store_dir, INDEX_FILE))
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def names(self):
+        return self.index['name'].tolist()
+
+    def num_points(self, idx):
+        return int(self.index['count'][idx])
+
+    @PerfReport.kernel('FrameStore.read_frame')
+    def read_frame(self, idx):
+        # Zero-copy (n, 4) view over the memory-mapped chunk
+        entry = self.index[idx]
+        count = int(entry['count'])
+        if count == 0:
+            return np.empty((0, 4), dtype=np.float32)
+        columns = np.memmap(FrameStore.chunk_path(self.store_dir, int(entry['chunk'])), dtype=np.float32,
+                            mode='r', offset=int(entry['offset']), shape=(4, count))
+        return columns.T
+
+    @staticmethod
+    def chunk_path(store_dir, chunk_id):
+        return os.path.join(store_dir, f"{CHUNK_PREFIX}{chunk_id:05d}.bin")
+
+    @staticmethod
+    def is_store(frames_dir):
+        return os.path.isfile(os.path.join(frames_dir, INDEX_FILE))
+
+    @staticmethod
+    def clear(store_dir):
+        for file in os.listdir(store_dir):
+            if file == INDEX_FILE or (file.startswith(CHUNK_PREFIX) and file.endswith('.bin')):
+                os.remove(os.path.join(store_dir, file))
+
+
+class FrameSource:
+    # Uniform, index-based access to the frames of a directory, whether they were saved
+    # as one PLY per scan or as a chunked frame store
+    def __init__(self, frames_dir):
+        self.frames_dir = frames_dir
+        if FrameStore.is_store(self.frames_dir):
+            self.store = FrameStore(self.frames_dir)
+            self.files = None
+            self.names = self.store.names
+        else:
+            self.store = None
+            self.files = sorted(file for file in os.listdir(self.frames_dir) if file.endswith(('.ply', '.pcd')))
+            self.names = [os.path.splitext(file)[0] for file in self.files]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, idx):
+        return self.read_frame(idx)
+
+    def read_frame(self, idx):
+        if self.store is not None:
+            return self.store.read_frame(idx)
+        return PointCloud.from_file(os.path.join(self.frames_dir, self.files[idx])).points
+
+    def signature(self):
+        # Hash of the name, size and mtime of every file the frames are read from, it changes
+        # whenever the frames are written again
+        if self.store is not None:
+            files = sorted(file for file in os.listdir(self.frames_dir)
+                           if file == INDEX_FILE or (file.startswith(CHUNK_PREFIX) and file.endswith('.bin')))
+        else:
+            files = self.files
+        stats = [(file, os.stat(os.path.join(self.frames_dir, file))) for file in files]
+        return hashlib.sha256(json.dumps([(file, stat.st_size, stat.st_mtime_ns) for file, stat in stats])
+                              .encode('utf-8')).hexdigest()
+
+    def num_points(self, idx):
+        # From the store index or the file header, without reading the points
+        if self.store is not None:
+            return self.store.num_points(idx)
+        path = os.path.join(self.frames_dir, self.files[idx])
+        with open(path, 'rb') as file:
+            for line in file:
+                words = line.split()
+                if words[:2] == [b'element', b'vertex'] or words[:1] == [b'POINTS']:
+                    return int(words[-1])
+                if words[:1] in ([b'end_header'], [b'DATA']):
+                    break
+        raise ValueError(f"No point count in the header of {path}")
+
+
+class FrameSink:
+    def __init__(self, frames_dir, save_as='ply', frames_per_chunk=500, pcd_data='binary'):
+        self.frames_dir = frames_dir
+        self.save_as = save_as
+        self.pcd_data = pcd_data
+        os.makedirs(self.frames_dir, exist_ok=True)
+
+        # Chunked stores append frames back to back, so writes into them must stay in order
+        self.ordered = self.save_as == 'chunked'
+        if self.save_as == 'chunked':
+            self.writer = FrameStoreWriter(self.frames_dir, frames_per_chunk)
+        elif self.save_as in ('ply', 'pcd'):
+            self.writer = None
+            # A stale index would shadow the per-scan files for every reader
+            FrameStore.clear(self.frames_dir)
+        else:
+            raise ValueError(f"Unsupported frame format: {self.save_as}")
+
+    def write(self, name, points):
+        if self.writer is not None:
+            self.writer.append(name, points)
+            return
+
+        if self.save_as == 'pcd':
+            PCDUtils.write_pcd(points, os.path.join(self.frames_dir, f"{name}.pcd"), self.pcd_data)
+        else:
+            PointCloud.from_array(points).to_file(os.path.join(self.frames_dir, f"{name}.ply"))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
@@ -0,0 +1,94 @@
+import numpy as np
+import utm
+from geopy.distance import geodesic
+from Utils.perf_report import PerfReport
+
+# WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = (1 - WGS84_F) * WGS84_A
+
+
+class GeodesyUtils:
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def vincenty_inverse(lat1, lon1, lat2, lon2, tolerance=1e-12, max_iters=200):
+        # Batched Vincenty inverse solution on WGS84, every pair is iterated at once
+        # and pairs drop out of the update as soon as their longitude difference converges
+        lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lat1, lon1, lat2, lon2))
+        L = lon2 - lon1
+        U1 = np.arctan((1 - WGS84_F) * np.tan(lat1))
+        U2 = np.arctan((1 - WGS84_F) * np.tan(lat2))
+        sinU1, cosU1 = np.sin(U1), np.cos(U1)
+        sinU2, cosU2 = np.sin(U2), np.cos(U2)
+
+        lam = L.copy()
+        active = np.ones(L.shape, dtype=bool)
+        for _ in range(max_iters):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.hypot(cosU2 * sin_lam, cosU1 * sinU2 - sinU1 * cosU2 * cos_lam)
+            cos_sigma = sinU1 * sinU2 + cosU1 * cosU2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                sin_alpha = np.where(sin_sigma > 0, cosU1 * cosU2 * sin_lam / sin_sigma, 0.0)
+                cos2_alpha = 1 - sin_alpha ** 2
+                # Equatorial lines have cos2_alpha = 0
+                cos_2sigma_m = np.where(cos2_alpha > 0, cos_sigma - 2 * sinU1 * sinU2 / cos2_alpha, 0.0)
+            C = WGS84_F / 16 * cos2_alpha * (4 + WGS84_F * (4 - 3 * cos2_alpha))
+            lam_next = L + (1 - C) * WGS84_F * sin_alpha * (
+                    sigma + C * sin_sigma * (cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+            converged = np.abs(lam_next - lam) <= tolerance
+            lam = np.where(active, lam_next, lam)
+            active &= ~converged
+            if not active.any():
+                break
+
+        u2 = cos2_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+        A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        delta_sigma = B * sin_sigma * (cos_2sigma_m + B / 4 * (
+                cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) -
+                B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+        distances = WGS84_B * A * (sigma - delta_sigma)
+
+        # Vincenty does not converge for nearly antipodal pairs, solve those few with Karney
+        for idx in np.flatnonzero(active):
+            distances.flat[idx] = geodesic((np.degrees(lat1.flat[idx]), np.degrees(lon1.flat[idx])),
+                                           (np.degrees(lat2.flat[idx]), np.degrees(lon2.flat[idx]))).meters
+
+        return distances
+
+    @staticmethod
+    @PerfReport.kernel('GeodesyUtils.track_distance')
+    def track_distance(latitudes, longitudes):
+        # Returns the total track length and the cumulative distance at every sample (starting at 0)
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        if latitudes.size < 2:
+            return 0.0, np.zeros(latitudes.size)
+
+        steps = GeodesyUtils.vincenty_inverse(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:])
+        cumulative = np.concatenate(([0.0], np.cumsum(steps)))
+        return float(cumulative[-1]), cumulative
+
+    @staticmethod
+    def utm_zone(latitude, longitude):
+        _, _, zone_number, zone_letter = utm.from_latlon(latitude, longitude)
+        return zone_number, zone_letter
+
+    @staticmethod
+    def latlon_to_utm(latitudes, longitudes, zone_number, zone_letter):
+        # Array in, array out. Every point is projected into the given zone, also past its edge,
+        # so a drive crossing a zone boundary stays in one continuous metric frame
+        eastings, northings, _, _ = utm.from_latlon(np.asarray(latitudes, dtype=np.float64),
+                                                    np.asarray(longitudes, dtype=np.float64),
+                                                    force_zone_number=zone_number, force_zone_letter=zone_letter)
+        return eastings, northings
+
+    @staticmethod
+    def utm_to_latlon(eastings, northings, zone_number, zone_letter):
+        # Inverse of latlon_to_utm, eastings outside the zone's nominal range are allowed for the same reason
+        return utm.to_latlon(np.asarray(eastings, dtype=np.float64), np.asarray(northings, dtype=np.float64),
+                             zone_number, zone_letter, strict=False)
@@ -1,16 +1,13 @@
-from Playground.playground_utils import PlaygroundUtils
 from Utils.preprocessor_utils import PreprocessorUtils
 import numpy as np
 from scipy.stats import gaussian_kde
 import plotly.graph_objects as go
-from pyntcloud import PyntCloud
 import open3d as o3d
-import pandas as pd
 from tqdm import tqdm
-from shapely.geometry import Polygon, Point
-import utm
+from Utils.geodesy_utils import GeodesyUtils
 import json
 import alphashape
+from Utils.perf_report import PerfReport
 
 
 class LaneMarkerUtils:
@@ -109,65 +106,43 @@ class LaneMarkerUtils:
         print(f"Histogram saved as {output_html}")
 
     @staticmethod
-    def apply_intensity_filter(map_file, filter_range):
-        lower, upper = filter_range
+    def apply_intensity_filter(map_file, filter_range, return_outliers=False):
         map_cloud = PreprocessorUtils.read_point_cloud(map_file)
-        map_df = map_cloud.points
-        map_points = map_df.values
+        intensity_mask = PreprocessorUtils.intensity_mask(map_cloud, filter_range)
 
-        intensity_axis = map_points[:, 3]
-        intensity_mask = np.logical_and(intensity_axis >= lower, intensity_axis <= upper)
-
-        inlier_points_df = map_df[intensity_mask]
-        outlier_points_df = map_df[~intensity_mask]
-
-        # Convert filtered DataFrames back to PyntClouds
-        inlier_cloud = PyntCloud(inlier_points_df)
-        outlier_cloud = PyntCloud(outlier_points_df)
-
-        return inlier_cloud, outlier_cloud
+        return map_cloud.split(intensity_mask, return_outliers)
 
     @staticmethod
-    def apply_clustering(obj, eps, min_points, print_progress=True):
+    @PerfReport.kernel('LaneMarkerUtils.apply_clustering')
+    def apply_clustering(obj, eps, min_points, print_progress=True, return_noise=False):
         cloud = PreprocessorUtils.read_point_cloud(obj)
-        pcd = PlaygroundUtils.pyntcloud_to_open3d(obj)
-        cloud_df = cloud.points
+        pcd = cloud.to_open3d()
 
         # Apply DBSCAN clustering
         with o3d.utility.VerbosityContextManager(o3d.utility.VerbosityLevel.Debug) as cm:
             labels = np.array(
                 pcd.cluster_dbscan(eps=eps, min_points=min_points, print_progress=print_progress))
 
-        # Add labels to the DataFrame
-        cloud_df['cluster'] = labels
-
-        clusters = []
-        noise_df = cloud_df[cloud_df['cluster'] == -1].copy()  # Noise points
-        noise_df.drop(columns=['cluster'], inplace=True)
-        noise_cloud = PyntCloud(noise_df)
-
-        for label in np.unique(labels):
-            if label != -1:  # Skip noise points
-                mask = cloud_df['cluster'] == label
-                cluster_df = cloud_df[mask].copy()
-                cluster_df.drop(columns=['cluster'], inplace=True)
-                clusters.append(cluster_df)
+        # Noise points
+        noise_cloud = cloud.select(labels == -1) if return_noise else None
 
-        # Concatenate all clusters into a single DataFrame
-        clusters_df = pd.concat(clusters, ignore_index=True)
-        clusters_cloud = PyntCloud(clusters_df)
+        # Gather all clustered points once, grouped by label, and hand out per-cluster views
+        clustered = np.flatnonzero(labels != -1)
+        order = clustered[np.argsort(labels[clustered], kind='stable')]
+        clusters_cloud = cloud.select(order)
+        _, starts = np.unique(labels[order], return_index=True)
+        bounds = np.append(starts, len(order))
+        clusters = [clusters_cloud[bounds[i]:bounds[i + 1]] for i in range(len(starts))]
 
         return clusters, clusters_cloud, noise_cloud
 
     @staticmethod
+    @PerfReport.kernel('LaneMarkerUtils.compute_hulls')
     def compute_hulls(clusters_list, alpha):
         hulls = []
         for cluster in tqdm(clusters_list, desc="Computing Hulls...", total=len(clusters_list)):
-            cloud_obj = PyntCloud(cluster)
-            cloud_points = cloud_obj.points.values
-            xy_pts = cloud_points[:, :2]
-            points = [Point(p[0], p[1]) for p in xy_pts]
-            points_tuples = [(p.x, p.y) for p in points]
+            xy_pts = cluster.xyz[:, :2].astype(np.float64)
+            points_tuples = list(map(tuple, xy_pts))
             try:
                 alpha_shape = alphashape.alphashape(points_tuples, alpha)
 
@@ -185,19 +160,17 @@ class LaneMarkerUtils:
         return hulls
 
     @staticmethod
+    @PerfReport.kernel('LaneMarkerUtils.convert_hulls_to_latlon')
     def convert_hulls_to_latlon(hulls_list, offset):
-        latlon_hulls = []
         offset_arr, zone_num, zone_letter = offset['utm_coords'], offset['zone_number'], offset['zone_letter']
-        for hull in hulls_list:
-            latlon = []
-            for point in hull:
-                x, y = point
-                utm_local_x = x + offset_arr[0]
-                utm_local_y = y + offset_arr[1]
-                lat, lon = utm.to_latlon(utm_local_x, utm_local_y, zone_num, zone_letter)
-                latlon.append([lon, lat])
-                latlon_matrix = np.array(latlon)
-            latlon_hulls.append(latlon_matrix)
+        if not hulls_list:
+            return []
+        # Every vertex of every hull goes through one inverse projection, then is split back per hull
+        vertices = np.concatenate([np.asarray(hull, dtype=np.float64).reshape(-1, 2) for hull in hulls_list])
+        lat, lon = GeodesyUtils.utm_to_latlon(vertices[:, 0] + offset_arr[0], vertices[:, 1] + offset_arr[1],
+                                              zone_num, zone_letter)
+        lonlat = np.column_stack((lon, lat))
+        latlon_hulls = np.split(lonlat, np.cumsum([len(hull) for hull in hulls_list])[:-1])
 
         return latlon_hulls
 
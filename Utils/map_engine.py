@@ -0,0 +1,303 @@
+import os
+import json
+import multiprocessing
+import numpy as np
+import matplotlib.pyplot as plt
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.colors import Normalize
+from tqdm import tqdm
+from Utils.frame_store import FrameSource
+from Utils.map_generator_utils import MapGenratorUtils
+from Utils.perf_report import PerfReport
+from Utils.ply_writer import PlyWriter
+from Utils.point_cloud import POINT_DTYPE, PointCloud
+from Utils.voxel_map import VoxelMap
+
+COLORED_DTYPE = np.dtype([(name, '<f4') for name in ['x', 'y', 'z', 'red', 'green', 'blue']])
+
+
+def write_slot(file, dtype, data_offset, offset, records):
+    # Writes records at record offset of a preallocated file, safe from any process since
+    # every frame owns a disjoint slot
+    if len(records) == 0:
+        return
+    slot = np.memmap(file, dtype=dtype, mode='r+', offset=data_offset + offset * dtype.itemsize,
+                     shape=(len(records),))
+    slot[:] = records
+    del slot
+
+
+class MapEngine:
+    # Reads and transforms every frame once and hands both the sensor-frame scan and the
+    # transformed one, with the frame's index and output slot, to each registered sink. Every
+    # frame's output slot is known from the per-frame point counts up front, so frames are
+    # processed independently across a process pool and written straight into the preallocated
+    # outputs. Only a small summary per frame and sink comes back to the parent, where each sink
+    # collects them in frame order before it finishes.
+    # Workers are spawned rather than forked, the launcher runs other stages on threads meanwhile.
+    worker_context = None
+
+    def __init__(self, tf_poses, lidar_frames_dir, workers=1):
+        self.tf_poses = tf_poses
+        self.frames = FrameSource(lidar_frames_dir)
+        assert len(tf_poses) == len(
+            self.frames), f"Mismatch between length of poses {len(tf_poses)} and length of lidar frames {len(self.frames)}"
+        self.workers = workers or os.cpu_count()
+        self.sinks = []
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+    def process_frame(self, idx, offset):
+        points = self.frames.read_frame(idx)
+        tf_points = MapGenratorUtils.transform_frames(self.tf_poses[idx], points)
+        return [sink.write(idx, offset, points, tf_points) for sink in self.sinks]
+
+    @staticmethod
+    def init_worker(engine):
+        MapEngine.worker_context = engine
+
+    @staticmethod
+    def process_index(idx, offset):
+        return MapEngine.worker_context.process_frame(idx, offset)
+
+    def process_frames(self, offsets):
+        # Per-frame sink summaries in frame order
+        if self.workers <= 1:
+            for idx, offset in enumerate(offsets):
+                yield self.process_frame(idx, offset)
+            return
+
+        window = self.workers * 4
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=MapEngine.init_worker, initargs=(self,)) as executor:
+            pending = deque()
+            for idx, offset in enumerate(offsets):
+                pending.append(executor.submit(PerfReport.call_in_worker, MapEngine.process_index, idx, offset))
+                if len(pending) >= window:
+                    yield PerfReport.worker_result(pending.popleft())
+            while pending:
+                yield PerfReport.worker_result(pending.popleft())
+
+    def run(self):
+        counts = np.array([self.frames.num_points(idx) for idx in range(len(self.frames))], dtype=np.int64)
+        offsets = (np.cumsum(counts) - counts).tolist()
+        PerfReport.count(frames=len(counts), points=int(counts.sum()))
+        try:
+            for sink in self.sinks:
+                sink.prepare(counts)
+            for summaries in tqdm(self.process_frames(offsets), desc='Generating Maps: ', total=len(offsets)):
+                for sink, summary in zip(self.sinks, summaries):
+                    sink.collect(summary)
+            for sink in self.sinks:
+                sink.finish()
+        except BaseException:
+            for sink in self.sinks:
+                sink.discard()
+            raise
+
+
+class MapSink:
+    # Full map, every frame in its own slot of map.ply. With a voxel size every frame is reduced to
+    # its voxel cells where it is processed and only the cells come back, folded into a VoxelMap as
+    # they arrive, so the map holds one point per occupied voxel and neither memory nor disk grows
+    # with drive time. Followers (the colored map) see the map as written: every frame, or the
+    # voxel map at the end
+    def __init__(self, map_file, voxel_size=None, voxel_reduction='mean', followers=()):
+        self.map_file = map_file
+        self.voxel_map = VoxelMap(voxel_size) if voxel_size else None
+        self.voxel_reduction = voxel_reduction
+        self.followers = list(followers)
+        self.data_offset = 0
+        self.total = 0
+
+    def prepare(self, counts):
+        self.total = int(np.sum(counts))
+        if self.voxel_map is not None:
+            return
+        self.data_offset = PlyWriter.allocate(self.map_file, POINT_DTYPE, self.total)
+        for follower in self.followers:
+            follower.prepare(counts)
+
+    @PerfReport.kernel('MapSink.write')
+    def write(self, idx, offset, points, tf_points):
+        if self.voxel_map is not None:
+            return self.voxel_map.cells(tf_points)
+        write_slot(self.map_file, POINT_DTYPE, self.data_offset, offset,
+                   np.ascontiguousarray(tf_points, dtype=np.float32).view(POINT_DTYPE).reshape(-1))
+        return [follower.write(idx, offset, points, tf_points) for follower in self.followers]
+
+    def collect(self, summary):
+        if self.voxel_map is not None:
+            self.voxel_map.add_cells(summary)
+            return
+        for follower, follower_summary in zip(self.followers, summary):
+            follower.collect(follower_summary)
+
+    def finish(self):
+        if self.voxel_map is not None:
+            voxel_points = self.voxel_map.points(self.voxel_reduction)
+            print(f"Map voxelized from {self.total} points to {len(voxel_points)} voxels "
+                  f"of {self.voxel_map.voxel_size} m")
+            PointCloud.from_array(voxel_points).to_file(self.map_file)
+            for follower in self.followers:
+                follower.prepare([len(voxel_points)])
+                follower.collect(follower.write(0, 0, None, voxel_points))
+        for follower in self.followers:
+            follower.finish()
+
+    def discard(self):
+        if os.path.exists(self.map_file):
+            os.remove(self.map_file)
+        for follower in self.followers:
+            follower.discard()
+
+
+class GroundSink:
+    # Ground plane points of every scan, found in the sensor frame and taken from the transformed
+    # scan. A frame's ground size is only known once RANSAC ran, so frames hand their ground points
+    # back and they are appended to ground_map.ply in frame order, the vertex count patched at the
+    # end. With a voxel size frames hand back their ground's voxel cells instead, folded into a
+    # VoxelMap as they arrive
+    def __init__(self, ground_map_file, ground_filter, dist_thresh, ransac_n, num_iters,
+                 voxel_size=None, voxel_reduction='mean'):
+        self.ground_map_file = ground_map_file
+        self.config = (ground_filter, dist_thresh, ransac_n, num_iters)
+        self.voxel_map = VoxelMap(voxel_size) if voxel_size else None
+        self.voxel_reduction = voxel_reduction
+        self.total = 0
+        # Opened on the first frame collected, the sink itself is sent to the pool workers
+        self.writer = None
+
+    def prepare(self, counts):
+        self.total = 0
+
+    @PerfReport.kernel('GroundSink.write')
+    def write(self, idx, offset, points, tf_points):
+        # Seeded by frame, the ground map comes out the same for any number of workers
+        ground = tf_points[MapGenratorUtils.ground_indices(points, *self.config, seed=idx)]
+        if self.voxel_map is not None:
+            return len(ground), self.voxel_map.cells(ground)
+        return len(ground), np.ascontiguousarray(ground, dtype=np.float32)
+
+    def collect(self, summary):
+        count, ground = summary
+        self.total += count
+        if self.voxel_map is not None:
+            self.voxel_map.add_cells(ground)
+            return
+        if self.writer is None:
+            self.writer = PlyWriter(self.ground_map_file, POINT_DTYPE)
+        if count:
+            self.writer.append(ground)
+
+    def finish(self):
+        if self.voxel_map is not None:
+            voxel_points = self.voxel_map.points(self.voxel_reduction)
+            print(f"Ground map voxelized from {self.total} points to {len(voxel_points)} voxels "
+                  f"of {self.voxel_map.voxel_size} m")
+            PointCloud.from_array(voxel_points).to_file(self.ground_map_file)
+            return
+        if self.writer is None:
+            self.writer = PlyWriter(self.ground_map_file, POINT_DTYPE)
+        self.writer.close()
+
+    def discard(self):
+        if self.writer is not None:
+            self.writer.discard()
+        elif os.path.exists(self.ground_map_file):
+            os.remove(self.ground_map_file)
+
+
+class ColoredSink:
+    # Map colored by height. The color scale needs the final z range, so frames write x, y, z
+    # into their slots and report their z range, and the colors are filled in chunks at the end
+    def __init__(self, colored_map_file, chunk_size=1_000_000):
+        self.colored_map_file = colored_map_file
+        self.chunk_size = chunk_size
+        self.data_offset = 0
+        self.count = 0
+        self.z_ranges = []
+
+    def prepare(self, counts):
+        self.count = int(np.sum(counts))
+        self.z_ranges = []
+        self.data_offset = PlyWriter.allocate(self.colored_map_file, COLORED_DTYPE, self.count)
+
+    @PerfReport.kernel('ColoredSink.write')
+    def write(self, idx, offset, points, tf_points):
+        records = np.zeros(len(tf_points), dtype=COLORED_DTYPE)
+        for column, name in enumerate(['x', 'y', 'z']):
+            records[name] = tf_points[:, column]
+        write_slot(self.colored_map_file, COLORED_DTYPE, self.data_offset, offset, records)
+        z_values = records['z'][np.isfinite(records['z'])]
+        return (float(z_values.min()), float(z_values.max())) if len(z_values) else None
+
+    def collect(self, z_range):
+        if z_range is not None:
+            self.z_ranges.append(z_range)
+
+    def finish(self):
+        z_ranges = self.z_ranges
+        if self.count == 0 or not z_ranges:
+            return
+        norm = Normalize(vmin=min(z_min for z_min, _ in z_ranges), vmax=max(z_max for _, z_max in z_ranges))
+        records = np.memmap(self.colored_map_file, dtype=COLORED_DTYPE, mode='r+',
+                            offset=self.data_offset, shape=(self.count,))
+        for start in range(0, len(records), self.chunk_size):
+            chunk = records[start:start + self.chunk_size]
+            colors = plt.cm.nipy_spectral(norm(chunk['z']))
+            for idx, name in enumerate(['red', 'green', 'blue']):
+                chunk[name] = colors[:, idx]
+        records.flush()
+        del records
+
+    def discard(self):
+        if os.path.exists(self.colored_map_file):
+            os.remove(self.colored_map_file)
+
+
+class StatsSink:
+    # Point count, bounds and intensity moments of the map, from per-frame partial sums
+    def __init__(self, stats_file):
+        self.stats_file = stats_file
+        self.partials = []
+
+    def prepare(self, counts):
+        self.partials = []
+
+    @PerfReport.kernel('StatsSink.write')
+    def write(self, idx, offset, points, tf_points):
+        finite = tf_points[np.isfinite(tf_points[:, :3]).all(axis=1)]
+        if len(finite) == 0:
+            return len(tf_points), None
+        intensity = finite[:, 3].astype(np.float64)
+        return len(tf_points), (len(finite), finite[:, :3].min(axis=0), finite[:, :3].max(axis=0),
+                                intensity.min(), intensity.max(), intensity.sum(), np.square(intensity).sum())
+
+    def collect(self, partial):
+        self.partials.append(partial)
+
+    def finish(self):
+        partials = self.partials
+        stats = {'frames': len(partials), 'points': int(sum(points for points, _ in partials))}
+        partials = [partial for _, partial in partials if partial is not None]
+        finite = int(sum(partial[0] for partial in partials))
+        stats['finite_points'] = finite
+        if finite:
+            mean = sum(partial[5] for partial in partials) / finite
+            sq_mean = sum(partial[6] for partial in partials) / finite
+            stats.update({
+                'bounds_min': np.min([partial[1] for partial in partials], axis=0).tolist(),
+                'bounds_max': np.max([partial[2] for partial in partials], axis=0).tolist(),
+                'intensity': {'min': float(min(partial[3] for partial in partials)),
+                              'max': float(max(partial[4] for partial in partials)),
+                              'mean': float(mean), 'std': float(np.sqrt(max(sq_mean - mean ** 2, 0.0)))},
+            })
+        with open(self.stats_file, 'w') as file:
+            json.dump(stats, file, indent=4)
+
+    def discard(self):
+        pass
@@ -1,9 +1,8 @@
 import numpy as np
-from pyntcloud import PyntCloud
-import os
-from tqdm import tqdm
+import open3d as o3d
 from Utils.preprocessor_utils import PreprocessorUtils
-from Playground.playground_utils import PlaygroundUtils
+from Utils.perf_report import PerfReport
+from Utils.pose_utils import PoseUtils
 
 
 class MapGenratorUtils:
@@ -11,106 +10,55 @@ class MapGenratorUtils:
         pass
 
     @staticmethod
-    def transform_frames(transformation_matrix, lidar_points):
-        # Convert lidar points to homogeneous coordinates
-        ones = np.ones((lidar_points.shape[0], 1))
-        homogeneous_points = np.hstack((lidar_points[:, :3], ones))
-
-        # Apply the transformation matrix
-        transformed_points = transformation_matrix @ homogeneous_points.T
-
-        # Convert back to Cartesian coordinates
-        transformed_points = transformed_points.T[:, :3]
-
-        # Append intensity back to the transformed points
-        if lidar_points.shape[1] == 4:
-            transformed_points = np.hstack((transformed_points, lidar_points[:, 3].reshape(-1, 1)))
-
-        return transformed_points
+    @PerfReport.kernel('MapGenratorUtils.transform_frames')
+    def transform_frames(transformation_matrix, lidar_points, in_place=False):
+        # Rotates and translates xyz in float32 and keeps the intensity column, in_place reuses
+        # a writable float32 frame instead of copying it
+        return PoseUtils.transform_points(transformation_matrix, lidar_points,
+                                          lidar_points if in_place else None)
 
     @staticmethod
-    def apply_radial_filter(obj, radius):
+    def apply_radial_filter(obj, radius, return_outliers=False):
         cloud = PreprocessorUtils.read_point_cloud(obj)
-        pcd = PlaygroundUtils.pyntcloud_to_open3d(obj)
-        cloud_df = cloud.points
-        distances = np.linalg.norm(np.asarray(pcd.points), axis=1)
-        mask = distances <= radius
-
-        inlier_points_df = cloud_df[mask]
-        outlier_points_df = cloud_df[~mask]
-
-        # Convert filtered DataFrames back to PyntClouds
-        inlier_cloud = PyntCloud(inlier_points_df)
-        outlier_cloud = PyntCloud(outlier_points_df)
+        mask = PreprocessorUtils.radial_mask(cloud, radius)
 
-        return inlier_cloud, outlier_cloud
+        return cloud.split(mask, return_outliers)
 
     @staticmethod
-    def plane_segmentation_mask(obj, dist_thresh, ransac_n, num_iters):
+    def plane_inliers(obj, dist_thresh, ransac_n, num_iters, seed=None):
         cloud = PreprocessorUtils.read_point_cloud(obj)
-        pcd = PlaygroundUtils.pyntcloud_to_open3d(obj)
-        cloud_df = cloud.points
+        pcd = cloud.to_open3d()
+        if seed is not None:
+            # RANSAC draws from Open3D's global generator, seeding it makes the plane repeatable
+            o3d.utility.random.seed(int(seed))
 
         # Apply plane segmentation
         plane_model, inliers = pcd.segment_plane(distance_threshold=dist_thresh,
                                                  ransac_n=ransac_n,
                                                  num_iterations=num_iters)
-
-        # Create a mask for inliers
-        inlier_mask = np.zeros(len(pcd.points), dtype=bool)
-        inlier_mask[inliers] = True
-
-        # Filtering inlier points based on the mask
-        inlier_points_df = cloud_df[inlier_mask]
-        outlier_points_df = cloud_df[~inlier_mask]
-
-        # Convert filtered DataFrames back to PyntClouds
-        inlier_cloud = PyntCloud(inlier_points_df)
-        outlier_cloud = PyntCloud(outlier_points_df)
-
-        return inlier_cloud, outlier_cloud
+        return np.asarray(inliers, dtype=np.int64)
 
     @staticmethod
-    def generate_map(tf_poses, lidar_frames_dir):
-        frames = sorted(os.path.join(lidar_frames_dir, file_name) for file_name in os.listdir(lidar_frames_dir) if
-                        file_name.endswith('.ply'))
-
-        assert len(tf_poses) == len(
-            frames), f"Mismatch between length of poses {len(tf_poses)} and length of lidar frames {len(frames)}"
-        tf_frame = []
-        for idx, file in tqdm(enumerate(frames), desc='Generating Map: ', total=len(frames)):
-            file_path = frames[idx]
-            cloud = PyntCloud.from_file(file_path)
-            points = cloud.points.values
-
-            tf_pose = tf_poses[idx]
-            tf_points = MapGenratorUtils.transform_frames(tf_pose, points)
-            tf_frame.append(tf_points)
+    @PerfReport.kernel('MapGenratorUtils.plane_segmentation_mask')
+    def plane_segmentation_mask(obj, dist_thresh, ransac_n, num_iters, return_outliers=False):
+        cloud = PreprocessorUtils.read_point_cloud(obj)
 
-        tf_map = np.vstack(tf_frame)
+        # Create a mask for inliers
+        inlier_mask = np.zeros(len(cloud), dtype=bool)
+        inlier_mask[MapGenratorUtils.plane_inliers(cloud, dist_thresh, ransac_n, num_iters)] = True
 
-        return tf_map
+        # Filtering inlier points based on the mask
+        return cloud.split(inlier_mask, return_outliers)
 
     @staticmethod
-    def generate_ground_map(tf_poses, lidar_frames_dir, radial_thresh, dist_thresh, ransac_n, num_iters, radial_mask=True):
-        frames = sorted(os.path.join(lidar_frames_dir, file_name) for file_name in os.listdir(lidar_frames_dir) if
-                        file_name.endswith('.ply'))
-
-        assert len(tf_poses) == len(
-            frames), f"Mismatch between length of poses {len(tf_poses)} and length of lidar frames {len(frames)}"
-
-        tf_ground = []
-        for idx, file in tqdm(enumerate(frames), desc='Generating Ground Map: ', total=len(frames)):
-            file_path = frames[idx]
-            cloud = PyntCloud.from_file(file_path)
-            if radial_mask:
-                cloud, _ = MapGenratorUtils.apply_radial_filter(cloud, radial_thresh)
-            ground_cloud, _ = MapGenratorUtils.plane_segmentation_mask(cloud, dist_thresh, ransac_n, num_iters)
-            ground_points = ground_cloud.points.values
-            tf_pose = tf_poses[idx]
-            tf_ground_points = MapGenratorUtils.transform_frames(tf_pose, ground_points)
-            tf_ground.append(tf_ground_points)
-
-        tf_ground = np.vstack(tf_ground)
-
-        return tf_ground
+    @PerfReport.kernel('MapGenratorUtils.ground_indices')
+    def ground_indices(points, ground_filter, dist_thresh, ransac_n, num_iters, seed=None):
+        # Indices of a sensor-frame scan's ground plane points, so they can be picked straight out
+        # of the same scan once it is transformed. RANSAC runs on the compact candidates that pass
+        # the ground FilterChain (finite, near-radius and any configured extra stages) only
+        cloud = PreprocessorUtils.read_point_cloud(points)
+        candidates = ground_filter.indices(cloud)
+        if len(candidates) < ransac_n:
+            return candidates[:0]
+        return candidates[MapGenratorUtils.plane_inliers(cloud.select(candidates), dist_thresh, ransac_n, num_iters,
+                                                         seed)]
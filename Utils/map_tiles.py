@@ -0,0 +1,156 @@
+import os
+import json
+import glob
+import numpy as np
+import shapely
+from plyfile import PlyData
+from shapely.geometry import Polygon, box
+from Utils.geodesy_utils import GeodesyUtils
+from Utils.perf_report import PerfReport
+from Utils.ply_writer import PlyWriter
+from Utils.point_cloud import FIELDS, POINT_DTYPE, PointCloud
+
+INDEX_FILE = 'tiles.json'
+# Tile coordinates are packed 32 bits per axis into one int64 key, so points group by tile with one sort
+TILE_BITS = 32
+TILE_OFFSET = 1 << (TILE_BITS - 1)
+
+
+class MapTiles:
+    # A map split into square tiles of the local frame (UTM minus the conversion offset), one PLY
+    # per occupied tile plus a JSON index of every tile's bounds and point count. Queries read the
+    # index only and load just the tiles touching the region asked for, so downstream steps can
+    # work through a map of any size tile by tile.
+    def __init__(self, tiles_dir):
+        self.tiles_dir = tiles_dir
+        with open(os.path.join(tiles_dir, INDEX_FILE), 'r') as file:
+            self.index = json.load(file)
+        self.tile_size = self.index['tile_size']
+        self.offset = self.index['offset']
+        self.tiles = self.index['tiles']
+
+    def __len__(self):
+        return len(self.tiles)
+
+    @staticmethod
+    @PerfReport.kernel('MapTiles.write')
+    def write(map_file, tiles_dir, tile_size, offset=None, chunk_size=1_000_000):
+        # Streams the map through in chunks, each chunk's points appended to their tile files, so
+        # memory is bounded by the chunk and not the map. Non-finite points belong to no tile
+        os.makedirs(tiles_dir, exist_ok=True)
+        for pattern in ('tile_*.ply', INDEX_FILE):
+            for stale in glob.glob(os.path.join(tiles_dir, pattern)):
+                os.remove(stale)
+
+        vertex = PlyData.read(map_file, mmap='r')['vertex'].data
+        header = PlyWriter.header(POINT_DTYPE).encode('ascii')
+        tiles = {}
+        try:
+            for start in range(0, len(vertex), chunk_size):
+                chunk = vertex[start:start + chunk_size]
+                records = np.empty(len(chunk), dtype=POINT_DTYPE)
+                for name in FIELDS:
+                    records[name] = chunk[name]
+                xyz = np.stack([records['x'], records['y'], records['z']], axis=1)
+                records = records[np.isfinite(xyz).all(axis=1)]
+                if len(records) == 0:
+                    continue
+
+                ij = np.floor(np.stack([records['x'], records['y']], axis=1) / tile_size).astype(np.int64)
+                keys = ((ij[:, 0] + TILE_OFFSET) << TILE_BITS) | (ij[:, 1] + TILE_OFFSET)
+                order = np.argsort(keys, kind='stable')
+                keys, records, ij = keys[order], records[order], ij[order]
+                starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+                for begin, end in zip(starts, np.append(starts[1:], len(keys))):
+                    i, j = int(ij[begin, 0]), int(ij[begin, 1])
+                    tile_points = records[begin:end]
+                    lower = [float(tile_points[name].min()) for name in ('x', 'y', 'z')]
+                    upper = [float(tile_points[name].max()) for name in ('x', 'y', 'z')]
+                    tile = tiles.get((i, j))
+                    if tile is None:
+                        tile = tiles[(i, j)] = {
+                            'file': f"tile_{i}_{j}.ply", 'i': i, 'j': j,
+                            'bounds': [i * tile_size, j * tile_size, (i + 1) * tile_size, (j + 1) * tile_size],
+                            'points_min': lower, 'points_max': upper, 'count': 0}
+                        with open(os.path.join(tiles_dir, tile['file']), 'wb') as file:
+                            file.write(header)
+                    else:
+                        tile['points_min'] = np.minimum(tile['points_min'], lower).tolist()
+                        tile['points_max'] = np.maximum(tile['points_max'], upper).tolist()
+                    with open(os.path.join(tiles_dir, tile['file']), 'ab') as file:
+                        file.write(tile_points.tobytes())
+                    tile['count'] += len(tile_points)
+        except BaseException:
+            for tile in tiles.values():
+                os.remove(os.path.join(tiles_dir, tile['file']))
+            raise
+
+        for tile in tiles.values():
+            PlyWriter.patch_count(os.path.join(tiles_dir, tile['file']), tile['count'])
+
+        index = {'tile_size': tile_size, 'offset': offset,
+                 'tiles': [tiles[key] for key in sorted(tiles)]}
+        # The index goes last and whole, its presence marks a complete set of tiles
+        index_file = os.path.join(tiles_dir, INDEX_FILE)
+        with open(index_file + '.tmp', 'w') as file:
+            json.dump(index, file, indent=4)
+        os.replace(index_file + '.tmp', index_file)
+        print(f"Map split into {len(tiles)} tiles of {tile_size} m")
+        return index
+
+    def to_local(self, latitudes, longitudes):
+        # Lat/lon to the local frame of the tiles, through the offset the map was built with
+        if self.offset is None:
+            raise ValueError(f"{self.tiles_dir} has no conversion offset, query it in local coordinates")
+        eastings, northings = GeodesyUtils.latlon_to_utm(latitudes, longitudes, self.offset['zone_number'],
+                                                         self.offset['zone_letter'])
+        return np.stack([eastings - self.offset['utm_coords'][0], northings - self.offset['utm_coords'][1]], axis=1)
+
+    def tiles_in_bbox(self, min_xy, max_xy):
+        return [tile for tile in self.tiles if tile['count'] and
+                tile['points_min'][0] <= max_xy[0] and tile['points_max'][0] >= min_xy[0] and
+                tile['points_min'][1] <= max_xy[1] and tile['points_max'][1] >= min_xy[1]]
+
+    def tiles_in_polygon(self, polygon):
+        return [tile for tile in self.tiles if tile['count'] and polygon.intersects(
+            box(tile['points_min'][0], tile['points_min'][1], tile['points_max'][0], tile['points_max'][1]))]
+
+    def read_tile(self, tile):
+        vertex = PlyData.read(os.path.join(self.tiles_dir, tile['file']))['vertex'].data
+        return PointCloud(np.ascontiguousarray(vertex, dtype=POINT_DTYPE))
+
+    def iter_tiles(self, tiles=None):
+        # (tile, cloud) one tile at a time, every tile of the map by default
+        for tile in self.tiles if tiles is None else tiles:
+            yield tile, self.read_tile(tile)
+
+    def load(self, tiles=None):
+        clouds = [cloud for _, cloud in self.iter_tiles(tiles)]
+        return PointCloud.concatenate(clouds) if clouds else PointCloud.empty()
+
+    @PerfReport.kernel('MapTiles.query_bbox')
+    def query_bbox(self, min_xy, max_xy, latlon=False):
+        # Points with min_xy <= (x, y) <= max_xy. With latlon the corners are (lat, lon) pairs
+        if latlon:
+            corners = self.to_local([min_xy[0], max_xy[0]], [min_xy[1], max_xy[1]])
+            min_xy, max_xy = corners.min(axis=0), corners.max(axis=0)
+        clouds = []
+        for _, cloud in self.iter_tiles(self.tiles_in_bbox(min_xy, max_xy)):
+            x, y = cloud.data['x'], cloud.data['y']
+            clouds.append(cloud.select((x >= min_xy[0]) & (x <= max_xy[0]) & (y >= min_xy[1]) & (y <= max_xy[1])))
+        return PointCloud.concatenate(clouds) if clouds else PointCloud.empty()
+
+    @PerfReport.kernel('MapTiles.query_polygon')
+    def query_polygon(self, polygon, latlon=False):
+        # Points inside a shapely Polygon or an (n, 2) vertex list. With latlon the vertices are (lat, lon) pairs
+        if latlon:
+            vertices = np.asarray(polygon.exterior.coords if isinstance(polygon, Polygon) else polygon,
+                                  dtype=np.float64)
+            polygon = Polygon(self.to_local(vertices[:, 0], vertices[:, 1]))
+        elif not isinstance(polygon, Polygon):
+            polygon = Polygon(np.asarray(polygon, dtype=np.float64))
+        shapely.prepare(polygon)
+        clouds = []
+        for _, cloud in self.iter_tiles(self.tiles_in_polygon(polygon)):
+            clouds.append(cloud.select(shapely.contains_xy(polygon, cloud.data['x'], cloud.data['y'])))
+        return PointCloud.concatenate(clouds) if clouds else PointCloud.empty()
@@ -0,0 +1,98 @@
+import struct
+import numpy as np
+from Utils.perf_report import PerfReport
+
+try:
+    import lzf
+except ImportError:
+    lzf = None
+
+FIELDS = ['x', 'y', 'z', 'intensity']
+
+
+class PCDUtils:
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def header(num_points, data='binary'):
+        return (f"# .PCD v0.7 - Point Cloud Data file format\n"
+                f"VERSION 0.7\n"
+                f"FIELDS {' '.join(FIELDS)}\n"
+                f"SIZE 4 4 4 4\n"
+                f"TYPE F F F F\n"
+                f"COUNT 1 1 1 1\n"
+                f"WIDTH {num_points}\n"
+                f"HEIGHT 1\n"
+                f"VIEWPOINT 0 0 0 1 0 0 0\n"
+                f"POINTS {num_points}\n"
+                f"DATA {data}\n")
+
+    @staticmethod
+    @PerfReport.kernel('PCDUtils.write_pcd')
+    def write_pcd(points, pcd_file, data='binary'):
+        points = np.asarray(points, dtype=np.float32)[:, :4]
+        if data == 'binary_compressed' and lzf is None:
+            print("python-lzf is not installed, writing uncompressed binary PCD instead")
+            data = 'binary'
+
+        with open(pcd_file, 'wb') as f:
+            f.write(PCDUtils.header(points.shape[0], data).encode('ascii'))
+            if data == 'binary':
+                # Interleaved little-endian records, x y z intensity per point
+                f.write(np.ascontiguousarray(points).tobytes())
+            elif data == 'binary_compressed':
+                # LZF-compressed field-major layout: all x, then all y, z and intensity
+                raw = np.ascontiguousarray(points.T).tobytes()
+                compressed = lzf.compress(raw, len(raw) + len(raw) // 16 + 64) if raw else b''
+                f.write(struct.pack('<II', len(compressed), len(raw)))
+                f.write(compressed)
+            elif data == 'ascii':
+                np.savetxt(f, points, fmt='%f %f %f %f')
+            else:
+                raise ValueError(f"Unsupported PCD data type: {data}")
+
+    @staticmethod
+    @PerfReport.kernel('PCDUtils.read_pcd')
+    def read_pcd(pcd_file):
+        with open(pcd_file, 'rb') as f:
+            header = {}
+            while True:
+                raw = f.readline()
+                if raw == b'':
+                    raise ValueError('truncated PCD header')
+                line = raw.decode('ascii').strip()
+                if not line or line.startswith('#'):
+                    continue
+                key, *values = line.split()
+                header[key] = values
+                if key == 'DATA':
+                    break
+            body = f.read()
+
+        fields = header['FIELDS']
+        sizes = [int(size) for size in header['SIZE']]
+        types = header['TYPE']
+        num_points = int(header['POINTS'][0])
+        data = header['DATA'][0]
+        dtype = np.dtype([(name, f"<{kind.lower()}{size}") for name, kind, size in zip(fields, types, sizes)])
+
+        if data == 'ascii':
+            records = np.loadtxt(body.decode('ascii').splitlines(), dtype=dtype, ndmin=1)
+        elif data == 'binary':
+            records = np.frombuffer(body, dtype=dtype, count=num_points)
+        elif data == 'binary_compressed':
+            if lzf is None:
+                raise ImportError("python-lzf is required to read binary_compressed PCD files")
+            compressed_size, raw_size = struct.unpack('<II', body[:8])
+            raw = lzf.decompress(body[8:8 + compressed_size], raw_size) if raw_size else b''
+            records = np.empty(num_points, dtype=dtype)
+            offset = 0
+            for name in fields:
+                column_dtype = dtype[name]
+                records[name] = np.frombuffer(raw, dtype=column_dtype, count=num_points, offset=offset)
+                offset += column_dtype.itemsize * num_points
+        else:
+            raise ValueError(f"Unsupported PCD data type: {data}")
+
+        return np.column_stack([records[name].astype(np.float32) for name in FIELDS])
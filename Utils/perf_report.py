@@ -0,0 +1,266 @@
+import os
+import json
+import time
+import threading
+import functools
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+REPORT_FILE = 'run_report.json'
+IO_FIELDS = ('rchar', 'wchar', 'read_bytes', 'write_bytes')
+# Seconds between resident memory samples while a stage is measured
+SAMPLE_INTERVAL = 0.1
+
+
+class PerfReport:
+    # Process-wide collector. Stage metrics are deltas of process counters over the stage's
+    # window, so they include the writer threads, worker processes and native threads a stage
+    # starts; stages that overlap in the task graph share those counters. Peak memory is sampled
+    # on a background thread for as long as any stage is measured, every stage keeps the highest
+    # resident memory seen within its own window.
+    stages = {}
+    kernels = {}
+    peaks = []
+    sampler = None
+    lock = threading.Lock()
+    local = threading.local()
+    started = None
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def reset():
+        with PerfReport.lock:
+            PerfReport.stages = {}
+            PerfReport.kernels = {}
+            PerfReport.started = (datetime.now().isoformat(timespec='seconds'), time.perf_counter(),
+                                  PerfReport.cpu_times())
+
+    @staticmethod
+    def cpu_times():
+        # (own CPU seconds, CPU seconds of finished child processes)
+        if resource is None:
+            return time.process_time(), 0.0
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return time.process_time(), children.ru_utime + children.ru_stime
+
+    @staticmethod
+    def resident_mb(pid):
+        with open(f'/proc/{pid}/statm', 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+    @staticmethod
+    def memory_mb():
+        # Resident memory of this process and of its live child processes (pool workers) summed,
+        # (None, None) without /proc
+        pid = os.getpid()
+        try:
+            own = PerfReport.resident_mb(pid)
+        except (OSError, ValueError, IndexError):
+            return None, None
+        children = 0.0
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat', 'r') as file:
+                    # The parent pid follows the state, after the parenthesised command name
+                    ppid = int(file.read().rsplit(')', 1)[1].split()[1])
+                if ppid == pid:
+                    children += PerfReport.resident_mb(entry)
+            except (OSError, ValueError, IndexError):
+                continue
+        return own, children
+
+    @staticmethod
+    def update_peaks(peaks):
+        own, children = PerfReport.memory_mb()
+        if own is None:
+            return
+        for peak in peaks:
+            peak[0] = max(peak[0], own)
+            peak[1] = max(peak[1], children)
+
+    @staticmethod
+    def sample_memory():
+        while True:
+            with PerfReport.lock:
+                if not PerfReport.peaks:
+                    PerfReport.sampler = None
+                    return
+                peaks = list(PerfReport.peaks)
+            PerfReport.update_peaks(peaks)
+            time.sleep(SAMPLE_INTERVAL)
+
+    @staticmethod
+    def track_peak():
+        # [own, children] peak resident memory from now on, raised by the sampler until untracked
+        peak = [0.0, 0.0]
+        PerfReport.update_peaks([peak])
+        with PerfReport.lock:
+            PerfReport.peaks.append(peak)
+            if PerfReport.sampler is None:
+                PerfReport.sampler = threading.Thread(target=PerfReport.sample_memory, daemon=True)
+                PerfReport.sampler.start()
+        return peak
+
+    @staticmethod
+    def untrack_peak(peak):
+        # By identity, the peaks of overlapping stages can hold equal values
+        with PerfReport.lock:
+            PerfReport.peaks = [tracked for tracked in PerfReport.peaks if tracked is not peak]
+        PerfReport.update_peaks([peak])
+        if peak[0] == 0.0:
+            # Not sampled, there is no /proc to read
+            return None, None
+        return round(peak[0], 1), round(peak[1], 1)
+
+    @staticmethod
+    def peak_rss_mb():
+        # High-water marks over the whole run of this process and of the largest finished child process
+        if resource is None:
+            return None, None
+        return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+
+    @staticmethod
+    def io_counters():
+        # Bytes through read/write calls (rchar, wchar) and bytes that reached the disk
+        try:
+            with open('/proc/self/io', 'r') as file:
+                counters = dict(line.split(':') for line in file.read().splitlines())
+            return {name: int(counters[name]) for name in IO_FIELDS}
+        except (OSError, KeyError, ValueError):
+            return {}
+
+    @staticmethod
+    @contextmanager
+    def measure(name):
+        metrics = {'frames': 0, 'points': 0}
+        stack = PerfReport.local.__dict__.setdefault('stack', [])
+        stack.append(metrics)
+        start_wall = time.perf_counter()
+        start_cpu, start_children = PerfReport.cpu_times()
+        start_io = PerfReport.io_counters()
+        peak = PerfReport.track_peak()
+        try:
+            yield metrics
+        finally:
+            stack.pop()
+            wall = time.perf_counter() - start_wall
+            cpu, children = PerfReport.cpu_times()
+            io = PerfReport.io_counters()
+            peak_rss, peak_child_rss = PerfReport.untrack_peak(peak)
+            metrics.update({
+                'wall_s': round(wall, 4),
+                'cpu_s': round(cpu - start_cpu, 4),
+                'children_cpu_s': round(children - start_children, 4),
+                # Near 1 or above is CPU-bound, well below 1 is waiting on I/O
+                'cpu_utilization': round((cpu - start_cpu + children - start_children) / wall, 3) if wall > 0 else None,
+                'peak_rss_mb': peak_rss,
+                'peak_child_rss_mb': peak_child_rss,
+            })
+            metrics.update({field: io[field] - start_io[field] for field in io if field in start_io})
+            if wall > 0:
+                metrics['frames_per_s'] = round(metrics['frames'] / wall, 2)
+                metrics['points_per_s'] = round(metrics['points'] / wall, 1)
+            with PerfReport.lock:
+                PerfReport.stages[name] = metrics
+
+    @staticmethod
+    def count(**counts):
+        # Adds to the counters (frames, points, ...) of the stage running on this thread
+        stack = PerfReport.local.__dict__.get('stack')
+        if not stack:
+            return
+        metrics = stack[-1]
+        for key, value in counts.items():
+            metrics[key] = metrics.get(key, 0) + int(value)
+
+    @staticmethod
+    def kernel(name):
+        # Decorator accumulating calls, wall and CPU time of a Utils kernel. CPU time is the
+        # calling thread's, worker processes hand theirs back through call_in_worker
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start_wall = time.perf_counter()
+                start_cpu = time.thread_time()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    wall = time.perf_counter() - start_wall
+                    cpu = time.thread_time() - start_cpu
+                    with PerfReport.lock:
+                        stats = PerfReport.kernels.setdefault(name, {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0})
+                        stats['calls'] += 1
+                        stats['wall_s'] += wall
+                        stats['cpu_s'] += cpu
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def drain_kernels():
+        with PerfReport.lock:
+            kernels, PerfReport.kernels = PerfReport.kernels, {}
+        return kernels
+
+    @staticmethod
+    def merge_kernels(kernels):
+        with PerfReport.lock:
+            for name, stats in kernels.items():
+                total = PerfReport.kernels.setdefault(name, {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0})
+                for key in total:
+                    total[key] += stats[key]
+
+    @staticmethod
+    def call_in_worker(fn, *args):
+        # Runs fn in a pool worker and returns its result with the kernel stats the call added,
+        # for merge_kernels in the parent
+        return fn(*args), PerfReport.drain_kernels()
+
+    @staticmethod
+    def worker_result(future):
+        # Result of a call_in_worker future, its kernel stats merged into this process' report
+        result, kernels = future.result()
+        PerfReport.merge_kernels(kernels)
+        return result
+
+    @staticmethod
+    def write(output_dir, **info):
+        started, start_wall, (start_cpu, start_children) = PerfReport.started or (None, time.perf_counter(), (0.0, 0.0))
+        cpu, children = PerfReport.cpu_times()
+        peak_rss, peak_child_rss = PerfReport.peak_rss_mb()
+        with PerfReport.lock:
+            report = {
+                **info,
+                'started': started,
+                'wall_s': round(time.perf_counter() - start_wall, 4),
+                'cpu_s': round(cpu - start_cpu, 4),
+                'children_cpu_s': round(children - start_children, 4),
+                'peak_rss_mb': peak_rss,
+                'peak_child_rss_mb': peak_child_rss,
+                'stages': PerfReport.stages,
+                'kernels': {name: {'calls': stats['calls'], 'wall_s': round(stats['wall_s'], 4),
+                                   'cpu_s': round(stats['cpu_s'], 4)}
+                            for name, stats in sorted(PerfReport.kernels.items())},
+            }
+        report_file = os.path.join(output_dir, REPORT_FILE)
+        with open(report_file, 'w') as file:
+            json.dump(report, file, indent=4)
+        return report_file
+
+
+def reset_lock_after_fork():
+    # A worker forked while another thread held the lock would otherwise wait on it forever
+    PerfReport.lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_lock_after_fork)
@@ -1,4 +1,5 @@
 from plyfile import PlyData
+from Utils.pcd_utils import PCDUtils
 import numpy as np
 
 
@@ -7,7 +8,7 @@ class PLYtoPCD:
         pass
 
     @staticmethod
-    def ply_to_pcd(ply_file, pcd_file):
+    def ply_to_pcd(ply_file, pcd_file, data='binary'):
         # Read the PLY file data
         ply_data = PlyData.read(ply_file)
         vertex_data = ply_data['vertex'].data
@@ -19,24 +20,7 @@ class PLYtoPCD:
         intensity = vertex_data['intensity']
 
         # Stack these arrays into a single numpy array
-        data = np.stack((x, y, z, intensity), axis=-1)
-        num_points = data.shape[0]
-
-        # Prepare the PCD file header
-        header = f"""# .PCD v0.7 - Point Cloud Data file format
-        VERSION 0.7
-        FIELDS x y z intensity
-        SIZE 4 4 4 4
-        TYPE F F F F
-        COUNT 1 1 1 1
-        WIDTH {num_points}
-        HEIGHT 1
-        VIEWPOINT 0 0 0 1 0 0 0
-        POINTS {num_points}
-        DATA ascii
-        """
+        points = np.stack((x, y, z, intensity), axis=-1)
 
         # Write the header and data to the PCD file
-        with open(pcd_file, 'w') as f:
-            f.write(header)
-            np.savetxt(f, data, fmt='%f %f %f %f')
+        PCDUtils.write_pcd(points, pcd_file, data)
@@ -0,0 +1,90 @@
+import os
+import numpy as np
+from numpy.lib.recfunctions import unstructured_to_structured
+
+PLY_TYPES = {'f4': 'float', 'f8': 'double', 'u1': 'uchar', 'i1': 'char',
+             'u2': 'ushort', 'i2': 'short', 'u4': 'uint', 'i4': 'int'}
+# Room for any vertex count, patched in place once the last record is written
+COUNT_WIDTH = 20
+HEADER_PREFIX = "ply\nformat binary_little_endian 1.0\nelement vertex "
+
+
+class PlyWriter:
+    # Binary little-endian PLY written record by record. Without a known count the header
+    # reserves a fixed-width vertex count that close() patches, so a map can be streamed to disk
+    # frame by frame while only the frame in hand is in memory.
+    def __init__(self, file, dtype, count=None):
+        self.file = file
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        self.expected = count
+        self.count = 0
+
+        header = PlyWriter.header(self.dtype, count)
+        self.handle = open(file, 'wb')
+        self.handle.write(header.encode('ascii'))
+        # Records start here, for memory-mapping the body once the file is closed
+        self.data_offset = self.handle.tell()
+
+    @staticmethod
+    def header(dtype, count=None):
+        dtype = np.dtype(dtype)
+        vertex_count = f"{count}" if count is not None else f"{0:<{COUNT_WIDTH}}"
+        return (f"{HEADER_PREFIX}{vertex_count}\n" +
+                ''.join(f"property {PLY_TYPES[dtype[name].str[1:]]} {name}\n" for name in dtype.names) +
+                "end_header\n")
+
+    @staticmethod
+    def allocate(file, dtype, count):
+        # Writes the header and sizes the body for count records, which can then be filled
+        # through a memory map from any process. Returns the byte offset of the first record
+        header = PlyWriter.header(np.dtype(dtype).newbyteorder('<'), count).encode('ascii')
+        with open(file, 'wb') as handle:
+            handle.write(header)
+            handle.truncate(len(header) + count * np.dtype(dtype).itemsize)
+        return len(header)
+
+    @staticmethod
+    def patch_count(file, count):
+        # Fills in the reserved vertex count of a file written with header(dtype) and appended to
+        with open(file, 'r+b') as handle:
+            handle.seek(len(HEADER_PREFIX))
+            handle.write(f"{count:<{COUNT_WIDTH}}".encode('ascii'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def append(self, records):
+        # Structured records of the writer's dtype, or an (n, fields) array in the same field order
+        records = np.asarray(records)
+        if records.dtype.names is None:
+            if records.dtype == self.dtype[0] and all(self.dtype[name] == records.dtype for name in self.dtype.names):
+                records = np.ascontiguousarray(records).view(self.dtype).reshape(-1)
+            else:
+                records = unstructured_to_structured(records, dtype=self.dtype)
+        self.handle.write(np.ascontiguousarray(records, dtype=self.dtype).tobytes())
+        self.count += len(records)
+
+    def close(self):
+        if self.handle.closed:
+            return
+        if self.expected is None:
+            self.handle.seek(len(HEADER_PREFIX))
+            self.handle.write(f"{self.count:<{COUNT_WIDTH}}".encode('ascii'))
+        elif self.count != self.expected:
+            self.handle.close()
+            os.remove(self.file)
+            raise ValueError(f"{self.file} declares {self.expected} vertices but {self.count} were written")
+        self.handle.close()
+
+    def discard(self):
+        # Drops a file that was not written to the end, it must not pass for a complete one
+        if not self.handle.closed:
+            self.handle.close()
+        if os.path.exists(self.file):
+            os.remove(self.file)
@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+import open3d as o3d
+from numpy.lib.recfunctions import structured_to_unstructured
+from plyfile import PlyData
+from pyntcloud import PyntCloud
+from Utils.pcd_utils import PCDUtils
+from Utils.ply_writer import PlyWriter
+from Utils.perf_report import PerfReport
+
+FIELDS = ['x', 'y', 'z', 'intensity']
+POINT_DTYPE = np.dtype([(name, '<f4') for name in FIELDS])
+
+
+class PointCloud:
+    # Thin wrapper around a packed float32 structured array (x, y, z, intensity).
+    # Slicing and the xyz/points/intensity accessors are views; a boolean mask gathers once.
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, item):
+        return PointCloud(self.data[item])
+
+    @property
+    def points(self):
+        return structured_to_unstructured(self.data, copy=False)
+
+    @property
+    def xyz(self):
+        return self.points[:, :3]
+
+    @property
+    def intensity(self):
+        return self.data['intensity']
+
+    def select(self, mask):
+        return PointCloud(self.data[mask])
+
+    def split(self, mask, return_outliers=False):
+        # Outliers cost a second full gather, so they are only built on request
+        inliers = self.select(mask)
+        outliers = self.select(~mask) if return_outliers else None
+        return inliers, outliers
+
+    @staticmethod
+    def empty(size=0):
+        return PointCloud(np.zeros(size, dtype=POINT_DTYPE))
+
+    @staticmethod
+    def concatenate(clouds):
+        return PointCloud(np.concatenate([cloud.data for cloud in clouds]))
+
+    @staticmethod
+    def from_array(points):
+        # (n, 4) float32 C-contiguous input is wrapped without a copy
+        points = np.ascontiguousarray(np.asarray(points)[:, :4], dtype=np.float32)
+        return PointCloud(points.view(POINT_DTYPE).reshape(-1))
+
+    @staticmethod
+    def from_pyntcloud(cloud):
+        return PointCloud.from_array(cloud.points[FIELDS].to_numpy(dtype=np.float32))
+
+    def to_pyntcloud(self):
+        return PyntCloud(pd.DataFrame(self.points, columns=FIELDS))
+
+    @staticmethod
+    def from_open3d(pcd, intensity=None):
+        xyz = np.asarray(pcd.points, dtype=np.float32)
+        cloud = PointCloud.empty(len(xyz))
+        cloud.xyz[:] = xyz
+        if intensity is not None:
+            cloud.intensity[:] = intensity
+        return cloud
+
+    def to_open3d(self):
+        pcd = o3d.geometry.PointCloud()
+        pcd.points = o3d.utility.Vector3dVector(self.xyz.astype(np.float64))
+        return pcd
+
+    @staticmethod
+    @PerfReport.kernel('PointCloud.from_file')
+    def from_file(file):
+        if file.endswith('.pcd'):
+            return PointCloud.from_array(PCDUtils.read_pcd(file))
+        vertex = PlyData.read(file)['vertex'].data
+        cloud = PointCloud.empty(len(vertex))
+        for name in FIELDS:
+            cloud.data[name] = vertex[name]
+        return cloud
+
+    @PerfReport.kernel('PointCloud.to_file')
+    def to_file(self, file):
+        # Binary little-endian PLY with float32 x, y, z, intensity properties
+        with PlyWriter(file, POINT_DTYPE, len(self.data)) as writer:
+            writer.append(self.data)
@@ -0,0 +1,54 @@
+import numpy as np
+
+
+class PoseUtils:
+    # Trajectories are contiguous (N, 4, 4) float64 arrays of homogeneous SE(3) poses. Every
+    # operation broadcasts, so a single (4, 4) pose combines with a whole trajectory at once.
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def as_poses(poses):
+        poses = np.ascontiguousarray(poses, dtype=np.float64)
+        if poses.shape[-2:] != (4, 4):
+            raise ValueError(f"Poses must be (N, 4, 4) or (4, 4) matrices, got shape {poses.shape}")
+        return poses
+
+    @staticmethod
+    def translations(poses):
+        return np.ascontiguousarray(poses[..., :3, 3])
+
+    @staticmethod
+    def compose(first, second):
+        # first @ second pose by pose
+        return np.matmul(first, second)
+
+    @staticmethod
+    def inverse(poses):
+        # [R t]^-1 = [R^T -R^T t], without a general 4x4 inversion
+        rotations = poses[..., :3, :3]
+        inverse = np.zeros_like(poses)
+        inverse[..., :3, :3] = np.swapaxes(rotations, -1, -2)
+        inverse[..., :3, 3] = -np.einsum('...ji,...j->...i', rotations, poses[..., :3, 3])
+        inverse[..., 3, 3] = 1.0
+        return inverse
+
+    @staticmethod
+    def apply(poses, points):
+        # One (3,) point per pose, or an (M, 3) set of points through a single pose
+        return np.einsum('...ij,...j->...i', poses[..., :3, :3], points) + poses[..., :3, 3]
+
+    @staticmethod
+    def transform_points(pose, points, out=None):
+        # R·p + t on the xyz columns of an (n, >=3) cloud in float32; further columns such as
+        # intensity are carried along. Without out a float32 copy is transformed, out=points
+        # transforms a writable float32 array in place
+        if out is None:
+            out = np.array(points, dtype=np.float32)
+        elif out is not points:
+            out[...] = points
+        xyz = out[:, :3]
+        rotated = xyz @ pose[:3, :3].T.astype(np.float32)
+        rotated += pose[:3, 3].astype(np.float32)
+        xyz[...] = rotated
+        return out
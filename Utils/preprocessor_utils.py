@@ -1,6 +1,8 @@
 from pyntcloud import PyntCloud
 import numpy as np
 from scipy.spatial import cKDTree
+from Utils.point_cloud import PointCloud
+from Utils.perf_report import PerfReport
 
 
 class PreprocessorUtils:
@@ -9,26 +11,29 @@ class PreprocessorUtils:
 
     @staticmethod
     def read_point_cloud(file_or_cloud):
-        if isinstance(file_or_cloud, PyntCloud):
+        if isinstance(file_or_cloud, PointCloud):
             return file_or_cloud
         elif isinstance(file_or_cloud, str):
-            cloud = PyntCloud.from_file(file_or_cloud)
-            return cloud
+            return PointCloud.from_file(file_or_cloud)
+        elif isinstance(file_or_cloud, np.ndarray):
+            return PointCloud.from_array(file_or_cloud)
+        elif isinstance(file_or_cloud, PyntCloud):
+            return PointCloud.from_pyntcloud(file_or_cloud)
         else:
-            raise ValueError("Input must be a file path (str) or a Point Cloud object.")
+            raise ValueError("Input must be a file path (str), a point array or a Point Cloud object.")
+
+    @staticmethod
+    def nan_mask(cloud):
+        return np.isfinite(cloud.xyz).all(axis=1)
 
     @staticmethod
     def remove_nans(file):
         pcd = PreprocessorUtils.read_point_cloud(file)
-        points_df = pcd.points
-        points_df.dropna(subset=['x', 'y', 'z'], inplace=True)
-        return PyntCloud(points_df)
+        return pcd.select(PreprocessorUtils.nan_mask(pcd))
 
     @staticmethod
-    def remove_ego(file, pog_z=-2.9):
-        pcd = PreprocessorUtils.read_point_cloud(file)
-        points_df = pcd.points
-        points = points_df.values
+    def ego_mask(cloud, pog_z=-2.9):
+        points = cloud.points
         # EGO Dimensions
         ego_length, ego_width, ego_height = 4.27, 2.02, 1.45
 
@@ -38,7 +43,6 @@ class PreprocessorUtils:
         lidar_roof_clearance = pog_z + ego_height
 
         # Masking
-        # points = np.asarray(pcd.points)
         x_mask = np.logical_or(points[:, 0] < -lidar_from_rear,
                                points[:, 0] > lidar_from_front)
         y_mask = np.logical_or(points[:, 1] < -lidar_from_right,
@@ -46,66 +50,140 @@ class PreprocessorUtils:
         z_mask = np.logical_or(points[:, 2] < pog_z,
                                points[:, 2] > 0)
 
-        ego_mask = np.logical_or.reduce((x_mask, y_mask, z_mask))
+        return np.logical_or.reduce((x_mask, y_mask, z_mask))
+
+    @staticmethod
+    def remove_ego(file, pog_z=-2.9, return_outliers=False):
+        pcd = PreprocessorUtils.read_point_cloud(file)
+        ego_mask = PreprocessorUtils.ego_mask(pcd, pog_z)
 
         # Filtering points using the mask and keeping the intensity
-        inlier_points = points_df[ego_mask]
-        outlier_points = points_df[~ego_mask]
+        return pcd.split(ego_mask, return_outliers)
+
+    @staticmethod
+    def box_mask(cloud, lower, upper, keep_inside=False):
+        xyz = cloud.xyz
+        inside = np.logical_and(xyz >= np.asarray(lower, dtype=np.float32),
+                                xyz <= np.asarray(upper, dtype=np.float32)).all(axis=1)
+        return inside if keep_inside else ~inside
 
-        # Convert filtered DataFrames back to PyntClouds, including intensity data
-        inlier_cloud = PyntCloud(inlier_points)
-        outlier_cloud = PyntCloud(outlier_points)
+    @staticmethod
+    def z_mask(cloud, z_range):
+        z_min, z_max = z_range
+        z_axis = cloud.data['z']
+        return np.logical_and(z_axis >= z_min, z_axis <= z_max)
 
-        return inlier_cloud, outlier_cloud
+    @staticmethod
+    def radial_mask(cloud, radius):
+        distances = np.linalg.norm(cloud.xyz, axis=1)
+        return distances <= radius
 
     @staticmethod
-    def statistical_outlier_removal(file, params):
-        k_nbs, z_thresh = params
+    def intensity_mask(cloud, intensity_range):
+        lower, upper = intensity_range
+        intensity_axis = cloud.intensity
+        return np.logical_and(intensity_axis >= lower, intensity_axis <= upper)
+
+    @staticmethod
+    def voxel_indices(points, voxel_size):
+        # Voxel id of every point (compact, 0..num_voxels-1) and the number of points per voxel
+        keys = np.floor(points[:, :3] / voxel_size).astype(np.int64)
+        keys -= keys.min(axis=0)
+        flat_keys = np.ravel_multi_index(keys.T, keys.max(axis=0) + 1)
+        _, inverse, counts = np.unique(flat_keys, return_inverse=True, return_counts=True)
+        return inverse.ravel(), counts
+
+    @staticmethod
+    @PerfReport.kernel('PreprocessorUtils.voxel_downsample')
+    def voxel_downsample(file, leaf_size, reduction='mean'):
+        # One point per occupied voxel at the centroid of its points, intensity is the
+        # voxel mean or, to keep bright lane paint from being averaged away, its max
         cloud = PreprocessorUtils.read_point_cloud(file)
-        # Extract only the spatial coordinates for KDTree calculations
-        spatial_points = np.array(cloud.points[['x', 'y', 'z']])
+        finite = PreprocessorUtils.nan_mask(cloud)
+        if not finite.all():
+            cloud = cloud.select(finite)
+        if len(cloud) == 0:
+            return cloud
+        inverse, counts = PreprocessorUtils.voxel_indices(cloud.xyz, leaf_size)
+        num_voxels = len(counts)
+
+        downsampled = PointCloud.empty(num_voxels)
+        for name in ('x', 'y', 'z'):
+            downsampled.data[name] = np.bincount(inverse, weights=cloud.data[name], minlength=num_voxels) / counts
+        if reduction == 'mean':
+            downsampled.data['intensity'] = np.bincount(inverse, weights=cloud.intensity,
+                                                        minlength=num_voxels) / counts
+        elif reduction == 'max':
+            order = np.argsort(inverse, kind='stable')
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            downsampled.data['intensity'] = np.maximum.reduceat(cloud.intensity[order], starts)
+        else:
+            raise ValueError(f"Unknown voxel reduction: {reduction}")
+        return downsampled
 
-        # Create a KDTree for efficient nearest neighbor search
-        kdtree = cKDTree(spatial_points)
-        distances, _ = kdtree.query(spatial_points, k=k_nbs + 1)
+    @staticmethod
+    def knn_mean_distances(kdtree, query_points, k_nbs, workers=1, block_size=65536):
+        # Mean distance to the k nearest neighbours (self excluded), queried block by block so the
+        # float64 (n, k+1) distance matrix never exists for the whole frame at once
+        mean_distances = np.empty(len(query_points), dtype=np.float32)
+        for start in range(0, len(query_points), block_size):
+            block = query_points[start:start + block_size]
+            distances, _ = kdtree.query(block, k=k_nbs + 1, workers=workers)
+            mean_distances[start:start + len(block)] = distances[:, 1:].mean(axis=1)
+        return mean_distances
+
+    @staticmethod
+    @PerfReport.kernel('PreprocessorUtils.sor_mask')
+    def sor_mask(cloud, params, workers=1, mode='exact', voxel_size=0.2):
+        k_nbs, z_thresh = params
+        # Extract only the spatial coordinates for KDTree calculations
+        spatial_points = cloud.xyz
+        if len(spatial_points) <= k_nbs:
+            return np.ones(len(cloud), dtype=bool)
+
+        if mode == 'exact':
+            # Create a KDTree for efficient nearest neighbor search
+            kdtree = cKDTree(spatial_points)
+            mean_distances = PreprocessorUtils.knn_mean_distances(kdtree, spatial_points, k_nbs, workers)
+            weights = None
+        elif mode == 'voxel':
+            # Approximate: neighbour statistics are computed between voxel centroids and
+            # shared by every point of a voxel, weighted by the number of points it holds
+            inverse, counts = PreprocessorUtils.voxel_indices(spatial_points, voxel_size)
+            centroids = np.zeros((len(counts), 3), dtype=np.float64)
+            np.add.at(centroids, inverse, spatial_points)
+            centroids /= counts[:, None]
+            k_voxels = min(k_nbs, len(counts) - 1)
+            if k_voxels < 1:
+                return np.ones(len(cloud), dtype=bool)
+            kdtree = cKDTree(centroids)
+            mean_distances = PreprocessorUtils.knn_mean_distances(kdtree, centroids, k_voxels, workers)
+            weights = counts
+        else:
+            raise ValueError(f"Unknown statistical outlier removal mode: {mode}")
 
         # Compute mean and standard deviation of distances to k nearest neighbors
-        mean_distances = np.mean(distances[:, 1:], axis=1)  # exclude the first distance (self)
-        std_dev = np.std(mean_distances)
-        mean_of_mean_distances = np.mean(mean_distances)
+        mean_of_mean_distances = np.average(mean_distances, weights=weights)
+        std_dev = np.sqrt(np.average((mean_distances - mean_of_mean_distances) ** 2, weights=weights))
 
         # Filter points based on the mean distance within standard deviation threshold
         mask = mean_distances <= (mean_of_mean_distances + z_thresh * std_dev)
-        outlier_mask = mean_distances > (mean_of_mean_distances + z_thresh * std_dev)
-
-        # Use masks to separate inliers and outliers, including all columns
-        inlier_points_df = cloud.points[mask]
-        outlier_points_df = cloud.points[outlier_mask]
+        if mode == 'voxel':
+            mask = mask[inverse]
+        return mask
 
-        inlier_cloud = PyntCloud(inlier_points_df)
-        outlier_cloud = PyntCloud(outlier_points_df)
+    @staticmethod
+    def statistical_outlier_removal(file, params, workers=1, mode='exact', voxel_size=0.2, return_outliers=False):
+        cloud = PreprocessorUtils.read_point_cloud(file)
+        mask = PreprocessorUtils.sor_mask(cloud, params, workers, mode, voxel_size)
 
-        return inlier_cloud, outlier_cloud
+        # Use the mask to separate inliers and outliers, including all columns
+        return cloud.split(mask, return_outliers)
 
     @staticmethod
-    def z_filter(file, z_range):
-        z_min, z_max = z_range
+    def z_filter(file, z_range, return_outliers=False):
         pcd = PreprocessorUtils.read_point_cloud(file)
-        points_df = pcd.points
-        points = points_df.values
-
-        z_axis = points[:, 2]
-        z_mask = np.logical_and(z_axis >= z_min, z_axis <= z_max)
+        z_mask = PreprocessorUtils.z_mask(pcd, z_range)
 
         # Filtering inlier points based on the mask
-        inlier_points_df = points_df[z_mask]
-        outlier_points_df = points_df[~z_mask]
-
-        # Convert filtered DataFrames back to PyntClouds
-        inlier_cloud = PyntCloud(inlier_points_df)
-        outlier_cloud = PyntCloud(outlier_points_df)
-
-        return inlier_cloud, outlier_cloud
-
-
-
+        return pcd.split(z_mask, return_outliers)
@@ -0,0 +1,215 @@
+import os
+import json
+import hashlib
+import threading
+
+CACHE_FILE = '.stage_cache.json'
+
+# Stage -> artifacts it reads, named '<settings.yaml section>.<entry>'. 'Frames' is the Preprocessor
+# frames when it is part of the run and the Extractor frames otherwise, the same switch the stages
+# use to pick their frames
+STAGE_INPUTS = {
+    'Extractor': [],
+    'Preprocessor': ['Extractor.frames_dir'],
+    'LidarOdometry': ['Frames'],
+    'TrajectoryTransformer': ['LidarOdometry.poses_file', 'Extractor.gnss_file'],
+    'MapGenerator': ['TrajectoryTransformer.tf_poses_file', 'Frames'],
+    'MapTiles': ['MapGenerator.map_file', 'MapGenerator.ground_map_file', 'TrajectoryTransformer.offset_file'],
+    'LaneMarker': ['MapGenerator.ground_map_file', 'TrajectoryTransformer.offset_file'],
+}
+
+
+class StageCache:
+    # Every artifact gets a key from the parameters that shape its content and the keys of the
+    # artifacts its stage reads, and a stage key covers the artifacts it writes. A recorded stage
+    # also keeps the size and mtime of what it wrote and read, so outputs rewritten outside the
+    # cache (an uncached run, a hand edit) are never mistaken for up to date ones.
+    def __init__(self, output_dir, bag_file, params, setts, preprocessed_frames, load_distance=lambda: None):
+        self.output_dir = output_dir
+        self.bag_file = bag_file
+        self.params = params
+        self.setts = setts
+        # The drive distance feeds the Preprocessor key, and is only known once the Extractor has run
+        self.load_distance = load_distance
+        self.cache_file = os.path.join(output_dir, CACHE_FILE)
+        self.entries = {}
+        # Records land from the task graph's threads
+        self.lock = threading.Lock()
+        if os.path.isfile(self.cache_file):
+            with open(self.cache_file, 'r') as file:
+                self.entries = json.load(file)
+
+        frames = 'Preprocessor.frames_dir' if preprocessed_frames else 'Extractor.frames_dir'
+        self.inputs = {stage: [frames if name == 'Frames' else name for name in names]
+                       for stage, names in STAGE_INPUTS.items()}
+        self.producers, self.artifact_keys, self.stage_keys = self.derive_keys(load_distance())
+
+    def derive_keys(self, distance):
+        producers, artifact_keys, stage_keys = {}, {}, {}
+        for stage, artifacts in StageCache.artifact_params(self.params, distance).items():
+            if stage == 'Extractor':
+                upstream = [StageCache.file_signature(self.bag_file)]
+            else:
+                upstream = [(name, artifact_keys.get(name)) for name in self.inputs[stage]]
+            for name, artifact_params in artifacts.items():
+                producers[name] = stage
+                artifact_keys[name] = StageCache.fingerprint(name, artifact_params, upstream)
+            stage_keys[stage] = StageCache.fingerprint(stage, {name: artifact_keys[name] for name in artifacts})
+        return producers, artifact_keys, stage_keys
+
+    @staticmethod
+    def fingerprint(*inputs):
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def file_signature(path):
+        # Path, size and mtime of a file, or of every file under a directory. None when it is missing
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+        if not os.path.isdir(path):
+            return None
+        files = []
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            for name in sorted(names):
+                stat = os.stat(os.path.join(root, name))
+                files.append([os.path.relpath(os.path.join(root, name), path), stat.st_size, stat.st_mtime_ns])
+        return [os.path.abspath(path), files]
+
+    @staticmethod
+    def artifact_params(params, distance=None):
+        # Stage -> {artifact: the parameters its content depends on}. Execution-only parameters
+        # (workers, queues, checkpoints, progress output) appear nowhere, nor do the switches of
+        # artifacts that are not written
+        extractor, preprocessor = params['Extractor'], params['Preprocessor']
+        frame_format = {'save_as': extractor['save_as']}
+        if extractor['save_as'] == 'chunked':
+            frame_format['frames_per_chunk'] = extractor['frames_per_chunk']
+        elif extractor['save_as'] == 'pcd':
+            frame_format['pcd_data'] = extractor['pcd_data']
+        gnss = {'gps_topic': params['Topics']['gps_topic']}
+
+        # The drive distance decides advanced preprocessing unless it is forced on. Before the first
+        # extraction the distance is unknown and the threshold stands in for it
+        advanced = preprocessor['advanced_preprocessing']
+        if not advanced:
+            advanced = (distance >= preprocessor['drive_distance_thresh'] if distance is not None
+                        else {'drive_distance_thresh': preprocessor['drive_distance_thresh']})
+        filters = {'basic_preprocessing': preprocessor['basic_preprocessing'], 'advanced_preprocessing': advanced,
+                   'extra_filters': preprocessor['extra_filters'],
+                   'voxel_downsample': preprocessor['voxel_downsample']}
+        if preprocessor['basic_preprocessing']:
+            filters['road_value_z'] = preprocessor['road_value_z']
+        if advanced:
+            filters.update({name: preprocessor[name] for name in ('k_nbs', 'z_thresh', 'sor_mode', 'z_filter')})
+            if preprocessor['sor_mode'] == 'voxel':
+                filters['sor_voxel_size'] = preprocessor['sor_voxel_size']
+        if preprocessor['voxel_downsample']:
+            filters.update({name: preprocessor[name] for name in ('voxel_leaf_size', 'voxel_reduction')})
+
+        odometry = {name: params['LidarOdometry'][name] for name in ('max_range', 'deskew')}
+
+        transformer = params['TrajectoryTransformer']
+        transform = {name: transformer[name] for name in ('frame_index', 'rot_offset', 'use_heading_from',
+                                                          'use_manual_georef')}
+        if transformer['use_heading_from'] == 'manual':
+            transform['manual_heading'] = transformer['manual_heading']
+        if transformer['use_manual_georef']:
+            transform['georef_start'] = transformer['georef_start']
+        plots = dict(transform, plot_point_budget=transformer['plot_point_budget'])
+
+        generator = params['MapGenerator']
+        voxels = {'voxel_downsample': generator['voxel_downsample']}
+        if generator['voxel_downsample']:
+            voxels.update({name: generator[name] for name in ('voxel_leaf_size', 'voxel_reduction')})
+        ground = dict(voxels, **{name: generator[name] for name in ('apply_radial_filter', 'distance_threshold',
+                                                                    'ransac_n', 'num_iters', 'ground_filters')})
+        if generator['apply_radial_filter']:
+            ground['radial_threshold'] = generator['radial_threshold']
+
+        lane_marker = {name: value for name, value in params['LaneMarker'].items()
+                       if name not in ('plot_histogram', 'print_progress')}
+
+        artifacts = {
+            'Extractor': {'Extractor.frames_dir': dict(frame_format, lidar_topic=params['Topics']['lidar_topic']),
+                          'Extractor.gnss_file': gnss, 'Extractor.distance_file': gnss},
+            'Preprocessor': {'Preprocessor.frames_dir': filters},
+            'LidarOdometry': {'LidarOdometry.poses_file': odometry,
+                              'LidarOdometry.registration_times_file': odometry},
+            'TrajectoryTransformer': {'TrajectoryTransformer.tf_poses_file': transform,
+                                      'TrajectoryTransformer.offset_file': transform,
+                                      'TrajectoryTransformer.org_plot_file': plots,
+                                      'TrajectoryTransformer.tf_plot_file': plots},
+            'MapGenerator': {'MapGenerator.map_file': voxels},
+            'MapTiles': {},
+            'LaneMarker': {'LaneMarker.clustered_markings': lane_marker, 'LaneMarker.geojson_path': lane_marker},
+        }
+        if generator['colored_map']:
+            artifacts['MapGenerator']['MapGenerator.colored_map_file'] = voxels
+        if generator['ground_map']:
+            artifacts['MapGenerator']['MapGenerator.ground_map_file'] = ground
+        if generator['map_stats']:
+            artifacts['MapGenerator']['MapGenerator.stats_file'] = voxels
+        if generator['tiles']:
+            artifacts['MapTiles']['MapGenerator.map_tiles_dir'] = {'tile_size': generator['tile_size']}
+            if generator['ground_map']:
+                artifacts['MapTiles']['MapGenerator.ground_tiles_dir'] = {'tile_size': generator['tile_size']}
+        if params['LaneMarker']['plot_histogram']:
+            artifacts['LaneMarker']['LaneMarker.plot_path'] = lane_marker
+        return artifacts
+
+    def path(self, artifact):
+        section, entry = artifact.split('.')
+        return os.path.join(self.output_dir, self.setts[section][entry])
+
+    def signature(self, artifact):
+        return StageCache.file_signature(self.path(artifact))
+
+    def is_fresh(self, stage, running=()):
+        # running holds the stages regenerating their artifacts in this launch, under the keys
+        # already mixed into this stage's key
+        entry = self.entries.get(stage)
+        if entry is None or entry['key'] != self.stage_keys[stage]:
+            return False
+        if any(self.signature(name) != signature for name, signature in entry['outputs'].items()):
+            return False
+        for name in self.inputs[stage]:
+            producer = self.producers.get(name)
+            if producer is None or producer in running:
+                continue
+            # An input is current if its producer recorded it under the expected key, or if it is
+            # still exactly what this stage read
+            signature = self.signature(name)
+            upstream = self.entries.get(producer, {})
+            recorded = (upstream.get('artifacts', {}).get(name) == self.artifact_keys[name] and
+                        upstream.get('outputs', {}).get(name) == signature)
+            if not recorded and entry['inputs'].get(name) != signature:
+                return False
+        return True
+
+    def invalidate(self, stage):
+        # Dropped before a stage runs, a run that dies halfway must not look up to date
+        with self.lock:
+            if self.entries.pop(stage, None) is not None:
+                self.save()
+
+    def record(self, stage):
+        # Keys are derived again from the finished run, the first extraction of a bag settles
+        # the drive distance the launch started without
+        with self.lock:
+            producers, artifact_keys, stage_keys = self.derive_keys(self.load_distance())
+            outputs = [name for name in artifact_keys if producers[name] == stage]
+            self.entries[stage] = {
+                'key': stage_keys[stage],
+                'artifacts': {name: artifact_keys[name] for name in outputs},
+                'outputs': {name: self.signature(name) for name in outputs},
+                'inputs': {name: self.signature(name) for name in self.inputs[stage] if name in producers},
+            }
+            self.save()
+
+    def save(self):
+        tmp_file = self.cache_file + '.tmp'
+        with open(tmp_file, 'w') as file:
+            json.dump(self.entries, file, indent=4)
+        os.replace(tmp_file, self.cache_file)
@@ -0,0 +1,170 @@
+import numpy as np
+import utm
+from tqdm import tqdm
+from rosbags.rosbag1 import Writer
+from rosbags.typesys import Stores, get_typestore
+
+SCAN_PERIOD_NS = 100_000_000
+START_STAMP_NS = 1_700_000_000_000_000_000
+
+
+class SyntheticBag:
+    # A straight two-lane road seen by a spinning lidar driving in the right lane:
+    # - road plane with dashed centre line and solid edge lines of bright paint
+    # - buildings along both sides as boxes of random length, setback, depth and height with gaps
+    #   between them, and randomly placed poles. Their end walls face along the road and the
+    #   facade line steps in and out, so consecutive scans differ along the road as well and
+    #   point-to-point ICP does not collapse the motion onto the road-parallel planes
+    # Scans are organised rings x columns clouds with NaN for rays without a return,
+    # like the RoboSense driver publishes them.
+    def __init__(self, rings=32, columns=1800, seed=0, sensor_height=1.9, max_range=100.0,
+                 elevation=(-25.0, 15.0)):
+        self.rings = rings
+        self.columns = columns
+        self.sensor_height = sensor_height
+        self.max_range = max_range
+        self.rng = np.random.default_rng(seed)
+
+        # Road layout (metres, road frame: x along the road, y to the left)
+        self.lane_width = 3.5
+        self.line_width = 0.15
+        self.dash_length, self.dash_period = 3.0, 12.0
+        self.vehicle_y = -self.lane_width / 2
+        # (min, max) of every building's length, gap to the next one, setback from the road centre,
+        # depth and height
+        self.building_length, self.building_gap = (6.0, 20.0), (2.0, 10.0)
+        self.setback, self.depth, self.height = (8.0, 16.0), (4.0, 12.0), (4.0, 15.0)
+        self.pole_spacing, self.pole_height = 2.5, 5.0
+
+        elevations = np.radians(np.linspace(elevation[0], elevation[1], rings))[:, None]
+        azimuths = np.radians(np.linspace(-180, 180, columns, endpoint=False))[None, :]
+        self.dx = np.cos(elevations) * np.cos(azimuths)
+        self.dy = np.cos(elevations) * np.sin(azimuths)
+        self.dz = np.sin(elevations) * np.ones_like(azimuths)
+        self.poles = np.empty((0, 3))
+        self.buildings = np.empty((0, 6))
+
+    def build_scene(self, length):
+        # Buildings (x_min, x_max, y_min, y_max, z_min, z_max) and poles (x, y, radius) over the
+        # drive plus the sensor range on both ends, in road coordinates with z from the sensor
+        start, end = -self.max_range, length + self.max_range
+        buildings = []
+        for side in (1, -1):
+            x = start + self.rng.uniform(0, self.building_gap[1])
+            while x < end:
+                building_length = self.rng.uniform(*self.building_length)
+                near = self.rng.uniform(*self.setback)
+                far = near + self.rng.uniform(*self.depth)
+                y_min, y_max = (near, far) if side > 0 else (-far, -near)
+                buildings.append((x, x + building_length, y_min, y_max, -self.sensor_height - 1.0,
+                                  self.rng.uniform(*self.height) - self.sensor_height))
+                x += building_length + self.rng.uniform(*self.building_gap)
+        self.buildings = np.array(buildings)
+
+        num_poles = int((end - start) / self.pole_spacing)
+        self.poles = np.column_stack([
+            self.rng.uniform(start, end, num_poles),
+            self.rng.choice([-1, 1], num_poles) * self.rng.uniform(self.lane_width + 1.5, self.setback[0] - 1,
+                                                                   num_poles),
+            self.rng.uniform(0.1, 0.5, num_poles)])
+
+    def paint_mask(self, x, y):
+        centre = (np.abs(y) < self.line_width / 2) & (np.mod(x, self.dash_period) < self.dash_length)
+        edges = np.abs(np.abs(y) - self.lane_width) < self.line_width / 2
+        return centre | edges
+
+    def scan(self, position):
+        # Casts every ray from the sensor at road coordinate x = position
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_hit = np.full(self.dx.shape, np.inf)
+            ground = self.dz < 0
+            t_hit[ground] = -self.sensor_height / self.dz[ground]
+            is_ground = ground.copy()
+
+            # Ray / box slab test against every building in range, in the sensor frame
+            nearby = self.buildings[(self.buildings[:, 1] > position - self.max_range) &
+                                    (self.buildings[:, 0] < position + self.max_range)]
+            origin = np.array([position, self.vehicle_y, 0.0])
+            directions = (self.dx, self.dy, self.dz)
+            for building in nearby:
+                t_near, t_far = np.full(self.dx.shape, -np.inf), np.full(self.dx.shape, np.inf)
+                for axis, direction in enumerate(directions):
+                    t_low = (building[2 * axis] - origin[axis]) / direction
+                    t_high = (building[2 * axis + 1] - origin[axis]) / direction
+                    t_near = np.fmax(t_near, np.fmin(t_low, t_high))
+                    t_far = np.fmin(t_far, np.fmax(t_low, t_high))
+                hit = (t_near <= t_far) & (t_near > 0) & (t_near < t_hit)
+                t_hit = np.where(hit, t_near, t_hit)
+                is_ground &= ~hit
+
+            nearby = self.poles[np.abs(self.poles[:, 0] - position) < self.max_range]
+            a = self.dx ** 2 + self.dy ** 2
+            for pole_x, pole_y, radius in nearby:
+                cx, cy = pole_x - position, pole_y - self.vehicle_y
+                b = -2 * (self.dx * cx + self.dy * cy)
+                disc = b ** 2 - 4 * a * (cx ** 2 + cy ** 2 - radius ** 2)
+                t_pole = (-b - np.sqrt(disc)) / (2 * a)
+                z_pole = t_pole * self.dz
+                hit = ((disc >= 0) & (t_pole > 0) & (z_pole > -self.sensor_height) &
+                       (z_pole < self.pole_height - self.sensor_height) & (t_pole < t_hit))
+                t_hit = np.where(hit, t_pole, t_hit)
+                is_ground &= ~hit
+
+        valid = np.isfinite(t_hit) & (t_hit <= self.max_range)
+        t_hit = np.where(valid, t_hit, np.nan) + self.rng.normal(0, 0.01, t_hit.shape)
+        points = np.empty((self.rings, self.columns, 4), dtype=np.float32)
+        points[..., 0] = t_hit * self.dx
+        points[..., 1] = t_hit * self.dy
+        points[..., 2] = t_hit * self.dz
+
+        # Asphalt and structures are dull, paint is bright with a small spread
+        intensity = np.where(is_ground, self.rng.normal(10, 2, t_hit.shape), self.rng.normal(25, 6, t_hit.shape))
+        paint = is_ground & valid & self.paint_mask(position + points[..., 0], self.vehicle_y + points[..., 1])
+        intensity[paint] = self.rng.normal(35, 4, np.count_nonzero(paint))
+        points[..., 3] = np.clip(intensity, 0, 255)
+        return points
+
+    def write(self, bag_file, length=200.0, speed=10.0, heading=0.0, origin=(52.478412, 13.337873),
+              gnss_noise=0.02, lidar_topic='/rslidar_points', gps_topic='/gnss'):
+        # length in metres at speed m/s with 10 Hz scans, heading in degrees clockwise from north.
+        # GNSS fixes follow the same path in UTM around origin, one per scan
+        typestore = get_typestore(Stores.ROS1_NOETIC)
+        types = typestore.types
+        Header, Time = types['std_msgs/msg/Header'], types['builtin_interfaces/msg/Time']
+        PointField, PointCloud2 = types['sensor_msgs/msg/PointField'], types['sensor_msgs/msg/PointCloud2']
+        NavSatFix, NavSatStatus = types['sensor_msgs/msg/NavSatFix'], types['sensor_msgs/msg/NavSatStatus']
+
+        num_frames = max(2, int(round(length / speed * 10)))
+        step = length / (num_frames - 1)
+        self.build_scene(length)
+        origin_x, origin_y, zone_number, zone_letter = utm.from_latlon(*origin)
+        bearing = np.radians(heading)
+        fields = [PointField(name=name, offset=4 * i, datatype=7, count=1)
+                  for i, name in enumerate(['x', 'y', 'z', 'intensity'])]
+
+        with Writer(bag_file) as writer:
+            lidar = writer.add_connection(lidar_topic, PointCloud2.__msgtype__, typestore=typestore)
+            gnss = writer.add_connection(gps_topic, NavSatFix.__msgtype__, typestore=typestore)
+            for idx in tqdm(range(num_frames), desc='Writing Synthetic Bag', total=num_frames):
+                position = idx * step
+                stamp = START_STAMP_NS + idx * SCAN_PERIOD_NS
+                header = Header(seq=idx, stamp=Time(sec=stamp // 10 ** 9, nanosec=stamp % 10 ** 9),
+                                frame_id='rslidar')
+
+                points = self.scan(position)
+                msg = PointCloud2(header=header, height=self.rings, width=self.columns, fields=fields,
+                                  is_bigendian=False, point_step=16, row_step=16 * self.columns,
+                                  data=points.view(np.uint8).reshape(-1), is_dense=False)
+                writer.write(lidar, stamp, typestore.serialize_ros1(msg, PointCloud2.__msgtype__))
+
+                # Road frame (along, left) -> east/north for a road running along the bearing
+                along, left = position, self.vehicle_y
+                east = along * np.sin(bearing) - left * np.cos(bearing) + self.rng.normal(0, gnss_noise)
+                north = along * np.cos(bearing) + left * np.sin(bearing) + self.rng.normal(0, gnss_noise)
+                latitude, longitude = utm.to_latlon(origin_x + east, origin_y + north, zone_number, zone_letter)
+                fix = NavSatFix(header=header, status=NavSatStatus(status=0, service=1),
+                                latitude=float(latitude), longitude=float(longitude), altitude=40.0,
+                                position_covariance=np.full(9, gnss_noise ** 2), position_covariance_type=1)
+                writer.write(gnss, stamp + 5_000_000, typestore.serialize_ros1(fix, NavSatFix.__msgtype__))
+
+        return num_frames
@@ -0,0 +1,62 @@
+import time
+from Utils.perf_report import PerfReport
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class TaskGraph:
+    # Tasks run on a thread pool as soon as every task they depend on has finished.
+    # Dependencies on tasks that were never added (stages left out of the run) count as met.
+    def __init__(self, max_workers=1, logger=None):
+        self.max_workers = max(1, max_workers)
+        self.logger = logger
+        self.tasks = {}
+        self.results = {}
+
+    def add(self, name, fn, deps=(), log=True):
+        if name in self.tasks:
+            raise ValueError(f"Task {name} is already in the graph")
+        self.tasks[name] = (fn, [dep for dep in deps if dep in self.tasks], log)
+        return name
+
+    def run_task(self, name):
+        fn, _, log = self.tasks[name]
+        log = log and self.logger is not None
+        start_time = time.time()
+        if log:
+            self.logger.info(f'Running {name}...')
+            with PerfReport.measure(name):
+                result = fn()
+        else:
+            result = fn()
+        if log:
+            self.logger.info(f'{name} took {time.time() - start_time:.2f} seconds.\n')
+        return result
+
+    def run(self):
+        # Tasks are added in dependency order, so scanning in insertion order is enough to find
+        # the ready ones; the first failure stops new submissions and is raised once the
+        # tasks already running have finished
+        pending = list(self.tasks)
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                if error is None:
+                    for name in [name for name in pending if all(dep in self.results for dep in self.tasks[name][1])]:
+                        if len(running) >= self.max_workers:
+                            break
+                        pending.remove(name)
+                        running[executor.submit(self.run_task, name)] = name
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                    except Exception as e:
+                        if error is None:
+                            error = e
+        if error is not None:
+            raise error
+        return self.results
@@ -1,9 +1,11 @@
 import numpy as np
 import json
-import utm
 import math
+import heapq
 import plotly.graph_objects as go
 import plotly.io as pio
+from Utils.pose_utils import PoseUtils
+from Utils.geodesy_utils import GeodesyUtils
 
 
 class TrajectoryTransformerUtils:
@@ -11,14 +13,9 @@ class TrajectoryTransformerUtils:
         pass
 
     @staticmethod
-    def load_states(file):
-        data = np.load(file)
-        translations = []
-        for tf in data:
-            translation = tf[:3, 3]
-            translations.append(translation)
-
-        return data, np.array(translations)
+    def load_states(file_or_poses):
+        data = PoseUtils.as_poses(np.load(file_or_poses) if isinstance(file_or_poses, str) else file_or_poses)
+        return data, PoseUtils.translations(data)
 
     @staticmethod
     def read_gps(file):
@@ -33,10 +30,47 @@ class TrajectoryTransformerUtils:
         return data
 
     @staticmethod
-    def plot(filename1: str, traj: list):
+    def decimate(track, point_budget):
+        # Douglas-Peucker refined greedily: the segment with the largest deviation is split first
+        # until the budget is spent, so turns survive while straight stretches collapse to their ends
+        num_points = len(track)
+        if not point_budget or num_points <= point_budget:
+            return track
+
+        # Deviations measured on a local equirectangular plane, degrees of longitude shrink with latitude
+        xy = np.column_stack((track[:, 1] * np.cos(np.radians(track[0, 0])), track[:, 0]))
+
+        def farthest(start, end):
+            if end - start < 2:
+                return None
+            segment = xy[end] - xy[start]
+            rel = xy[start + 1:end] - xy[start]
+            length = np.hypot(segment[0], segment[1])
+            if length > 0:
+                deviation = np.abs(segment[0] * rel[:, 1] - segment[1] * rel[:, 0]) / length
+            else:
+                deviation = np.hypot(rel[:, 0], rel[:, 1])
+            idx = int(np.argmax(deviation))
+            return -deviation[idx], start + 1 + idx, start, end
+
+        keep = [0, num_points - 1]
+        heap = [farthest(0, num_points - 1)]
+        while heap and len(keep) < point_budget:
+            neg_deviation, idx, start, end = heapq.heappop(heap)
+            if neg_deviation == 0:
+                break
+            keep.append(idx)
+            for segment in (farthest(start, idx), farthest(idx, end)):
+                if segment is not None:
+                    heapq.heappush(heap, segment)
+
+        return track[np.sort(keep)]
+
+    @staticmethod
+    def plot(filename1: str, traj: list, point_budget=None):
         def lat_lng_bounds(latitudes, longitudes):
-            min_lat, max_lat = min(latitudes), max(latitudes)
-            min_lng, max_lng = min(longitudes), max(longitudes)
+            min_lat, max_lat = np.min(latitudes), np.max(latitudes)
+            min_lng, max_lng = np.min(longitudes), np.max(longitudes)
             return min_lat, min_lng, max_lat, max_lng
 
         def map_center_and_zoom(min_lat, min_lng, max_lat, max_lng):
@@ -53,24 +87,22 @@ class TrajectoryTransformerUtils:
             return center_lat, center_lng, zoom
 
         traces = []
-        all_latitudes = []
-        all_longitudes = []
-
         for t in traj:
             name, mat = t
-            latitudes = mat[:, 0]
-            longitudes = mat[:, 1]
-            all_latitudes.extend(latitudes)
-            all_longitudes.extend(longitudes)
+            # Lines over a decimated track instead of a marker per sample
+            mat = TrajectoryTransformerUtils.decimate(mat, point_budget)
             trace = go.Scattermapbox(
-                lon=longitudes,
-                lat=latitudes,
-                mode='markers',
-                marker=go.scattermapbox.Marker(size=8),
+                lon=mat[:, 1],
+                lat=mat[:, 0],
+                mode='lines',
+                line=dict(width=3),
                 name=name
             )
             traces.append(trace)
 
+        # Bounds over the full tracks, decimation may drop extreme samples on straight stretches
+        all_latitudes = np.concatenate([mat[:, 0] for _, mat in traj])
+        all_longitudes = np.concatenate([mat[:, 1] for _, mat in traj])
         min_lat, min_lng, max_lat, max_lng = lat_lng_bounds(all_latitudes, all_longitudes)
         center_lat, center_lng, zoom = map_center_and_zoom(min_lat, min_lng, max_lat, max_lng)
 
@@ -87,12 +119,14 @@ class TrajectoryTransformerUtils:
             margin=dict(l=0, r=0, t=0, b=0),
             legend=dict(x=0, y=1, bgcolor='rgba(255, 255, 255, 0.5)')
         )
-        pio.write_html(fig, file=filename1)
+        # plotly.js is written once next to the HTML files and shared by all of them
+        pio.write_html(fig, file=filename1, include_plotlyjs='directory')
 
     @staticmethod
     def compute_offset(georef):
         lat, lon = georef
-        utm_x, utm_y, zone_num, zone_letter = utm.from_latlon(lat, lon)
+        zone_num, zone_letter = GeodesyUtils.utm_zone(lat, lon)
+        utm_x, utm_y = GeodesyUtils.latlon_to_utm(lat, lon, zone_num, zone_letter)
         array = np.array([utm_x, utm_y])
         offset = [array, zone_num, zone_letter]
         return offset
@@ -100,33 +134,19 @@ class TrajectoryTransformerUtils:
     @staticmethod
     def convert_global_to_local(gps_data):
         latlon_gps = gps_data[:, :2]
-        offset = TrajectoryTransformerUtils.compute_offset(latlon_gps[0])
-        offset = offset[0]
-        utm_mat = []
-        for lat, lon in latlon_gps:
-            ux, uy, _, _ = utm.from_latlon(lat, lon)
-            utm_arr = np.array([ux, uy])
-            utm_mat.append(utm_arr)
-
-        utm_mat = np.array(utm_mat)
-        local_mat = utm_mat - offset
+        offset, zone_num, zone_letter = TrajectoryTransformerUtils.compute_offset(latlon_gps[0])
+        utm_x, utm_y = GeodesyUtils.latlon_to_utm(latlon_gps[:, 0], latlon_gps[:, 1], zone_num, zone_letter)
+        local_mat = np.column_stack((utm_x, utm_y)) - offset
 
         return local_mat
 
     @staticmethod
     def convert_local_to_global(local_data, offset):
-        local_data = local_data[:, :2]
         utm_x, utm_y = offset[0]
         zone_num = offset[1]
         zone_letter = offset[2]
-        global_mat = []
-        for local_x, local_y in local_data:
-            utm_X, utm_Y = local_x + utm_x, local_y + utm_y
-            lat_x, lat_y = utm.to_latlon(utm_X, utm_Y, zone_num, zone_letter)
-            lat_arr = np.array([lat_x, lat_y])
-            global_mat.append(lat_arr)
-
-        global_mat = np.array(global_mat)
+        lat, lon = GeodesyUtils.utm_to_latlon(local_data[:, 0] + utm_x, local_data[:, 1] + utm_y, zone_num, zone_letter)
+        global_mat = np.column_stack((lat, lon))
 
         return global_mat
 
@@ -0,0 +1,90 @@
+import numpy as np
+from Utils.perf_report import PerfReport
+
+# Voxel coordinates are packed 21 bits per axis into one int64 key, in i, j, k order so sorting
+# keys sorts voxels the way PreprocessorUtils.voxel_indices does
+KEY_BITS = 21
+KEY_OFFSET = 1 << (KEY_BITS - 1)
+
+
+class VoxelMap:
+    # Sparse voxel grid accumulated frame by frame. Every occupied cell keeps the coordinate and
+    # intensity sums, the max intensity and the hit count of its returns, so the map grows with
+    # the area covered, not with drive time. Frames are reduced to their cells on arrival, or by
+    # cells() in another process and handed to add_cells(), and merged into the sorted cell arrays
+    # in batches that grow with the map, keeping merges amortised.
+    def __init__(self, voxel_size, batch_cells=1_000_000):
+        self.voxel_size = voxel_size
+        self.batch_cells = batch_cells
+        self.keys = np.empty(0, dtype=np.int64)
+        self.sums = np.empty((0, 4), dtype=np.float64)
+        self.max_intensity = np.empty(0, dtype=np.float32)
+        self.hits = np.empty(0, dtype=np.int64)
+        self.pending = []
+        self.pending_cells = 0
+
+    def __len__(self):
+        self.merge()
+        return len(self.keys)
+
+    def voxel_keys(self, xyz):
+        ijk = np.floor(xyz / self.voxel_size).astype(np.int64)
+        if len(ijk) and (ijk.min() < -KEY_OFFSET or ijk.max() >= KEY_OFFSET):
+            raise ValueError(f"Map extends beyond {KEY_OFFSET * self.voxel_size:.0f} m from the origin, "
+                             f"too far for {self.voxel_size} m voxels")
+        ijk += KEY_OFFSET
+        return (ijk[:, 0] << (2 * KEY_BITS)) | (ijk[:, 1] << KEY_BITS) | ijk[:, 2]
+
+    @staticmethod
+    def reduce(keys, sums, max_intensity, hits):
+        # Cells of the same key combined, keys come back sorted and unique
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        return (keys[starts], np.add.reduceat(sums[order], starts, axis=0),
+                np.maximum.reduceat(max_intensity[order], starts), np.add.reduceat(hits[order], starts))
+
+    @PerfReport.kernel('VoxelMap.cells')
+    def cells(self, points):
+        # One batch of points reduced to its occupied cells (sorted keys, sums, max intensity, hits),
+        # None without finite points. Cells are small and can be built wherever the points are
+        points = np.asarray(points)
+        points = points[np.isfinite(points[:, :3]).all(axis=1)]
+        if len(points) == 0:
+            return None
+        return VoxelMap.reduce(self.voxel_keys(points[:, :3]), points[:, :4].astype(np.float64),
+                               points[:, 3].astype(np.float32), np.ones(len(points), dtype=np.int64))
+
+    @PerfReport.kernel('VoxelMap.add_cells')
+    def add_cells(self, cells):
+        if cells is None:
+            return
+        self.pending.append(cells)
+        self.pending_cells += len(cells[0])
+        if self.pending_cells >= max(self.batch_cells, len(self.keys)):
+            self.merge()
+
+    def add(self, points):
+        self.add_cells(self.cells(points))
+
+    def merge(self):
+        if not self.pending:
+            return
+        parts = [(self.keys, self.sums, self.max_intensity, self.hits)] + self.pending
+        self.keys, self.sums, self.max_intensity, self.hits = VoxelMap.reduce(
+            *(np.concatenate([part[field] for part in parts]) for field in range(4)))
+        self.pending = []
+        self.pending_cells = 0
+
+    def points(self, reduction='mean'):
+        # (n, 4) float32 centroids with the voxel's mean or, to keep lane paint bright, max intensity
+        self.merge()
+        points = np.empty((len(self.keys), 4), dtype=np.float32)
+        points[:, :3] = self.sums[:, :3] / self.hits[:, None]
+        if reduction == 'mean':
+            points[:, 3] = self.sums[:, 3] / self.hits
+        elif reduction == 'max':
+            points[:, 3] = self.max_intensity
+        else:
+            raise ValueError(f"Unknown voxel reduction: {reduction}")
+        return points
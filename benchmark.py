@@ -0,0 +1,143 @@
+from launcher import LaunchSequence
+from Utils.synthetic_bag import SyntheticBag
+from Utils.perf_report import REPORT_FILE
+from run import setup_logging
+import shutil
+import json
+import yaml
+import os
+import time
+import logging
+import numpy as np
+
+BENCHMARK_FILE = 'benchmark_report.json'
+
+
+def generate_bag(bench_setts, params, length, logger=logging.getLogger(__name__)):
+    # Bags are named after everything that shapes them, so an existing one can be reused
+    bag_file = os.path.join(bench_setts['work_dir'], f"synthetic_{length}m_{bench_setts['rings']}x{bench_setts['columns']}_"
+                                                     f"{bench_setts['speed']}mps_seed{bench_setts['seed']}.bag")
+    if os.path.exists(bag_file):
+        logger.info(f'Reusing synthetic bag {bag_file}')
+        return bag_file
+
+    logger.info(f'Writing synthetic bag {bag_file}...')
+    synthetic = SyntheticBag(bench_setts['rings'], bench_setts['columns'], bench_setts['seed'])
+    synthetic.write(bag_file + '.tmp', length, bench_setts['speed'], bench_setts['heading'],
+                    params['TrajectoryTransformer']['georef_start'], bench_setts['gnss_noise'],
+                    params['Topics']['lidar_topic'], params['Topics']['gps_topic'])
+    os.replace(bag_file + '.tmp', bag_file)
+    return bag_file
+
+
+def odometry_path(setts, output_dir):
+    # Odometry path length and the GNSS drive distance. A scene ICP cannot lock onto collapses the
+    # trajectory to near zero, which would make every downstream stage look cheap
+    poses = np.load(os.path.join(output_dir, setts['LidarOdometry']['poses_file']))
+    path_length = float(np.linalg.norm(np.diff(poses[:, :3, 3], axis=0), axis=1).sum())
+    with open(os.path.join(output_dir, setts['Extractor']['distance_file']), 'r') as file:
+        drive_distance = json.load(file)['distance']
+    return path_length, drive_distance
+
+
+def summarize(length, report):
+    # Whole-run numbers plus throughput of every stage that counted frames or points
+    summary = {
+        'length_m': length,
+        'wall_s': report['wall_s'],
+        'cpu_s': report['cpu_s'],
+        'peak_rss_mb': report['peak_rss_mb'],
+        'stages': {name: {key: stage.get(key) for key in ('wall_s', 'frames', 'points', 'frames_per_s', 'points_per_s')}
+                   for name, stage in report['stages'].items()},
+    }
+    extractor = report['stages'].get('Extractor', {})
+    summary['frames'] = extractor.get('frames')
+    summary['points'] = extractor.get('points')
+    return summary
+
+
+def print_summary(results):
+    stages = []
+    for result in results:
+        stages += [name for name in result['stages'] if name not in stages]
+
+    print(f"\n{'Stage':<34}" + ''.join(f"{str(result['length_m']) + ' m':>24}" for result in results))
+    print(f"{'':<34}" + ''.join(f"{'wall s / kpts/s':>24}" for _ in results))
+    for name in stages:
+        row = f'{name:<34}'
+        for result in results:
+            stage = result['stages'].get(name)
+            if stage is None:
+                row += f"{'-':>24}"
+                continue
+            throughput = f"{stage['points_per_s'] / 1000:.1f}" if stage.get('points') else '-'
+            row += f"{stage['wall_s']:>14.2f} / {throughput:>7}"
+        print(row)
+    print(f'{"Total":<34}' + ''.join(f"{result['wall_s']:>14.2f} / {'-':>7}" for result in results) + '\n')
+
+
+if __name__ == '__main__':
+    logger = setup_logging()
+
+    with open('Config/benchmark_settings.yaml', 'r') as benchmark_settings:
+        try:
+            bench_setts = yaml.safe_load(benchmark_settings)
+        except yaml.YAMLError as exc:
+            logger.error(f"Error reading YAML file: {exc}")
+            exit(1)
+
+    with open('Params/params.yaml', 'r') as parameters:
+        try:
+            params = yaml.safe_load(parameters)
+        except yaml.YAMLError as exc:
+            logger.error(f"Error reading YAML file: {exc}")
+            exit(1)
+
+    with open('Config/settings.yaml', 'r') as settings:
+        try:
+            setts = yaml.safe_load(settings)
+        except yaml.YAMLError as exc:
+            logger.error(f"Error reading YAML file: {exc}")
+            exit(1)
+
+    work_dir = bench_setts['work_dir']
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+
+    results = []
+    for length in bench_setts['scales']:
+        bag_file = generate_bag(bench_setts, params, length, logger)
+
+        # Every scale starts from an empty output directory so no stage output is reused
+        output_dir = os.path.join(work_dir, f'run_{length}m')
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        os.makedirs(output_dir)
+
+        logger.info(f'BENCHMARKING {length} M DRIVE...')
+        start_time = time.time()
+        LaunchSequence(
+            bag_file, output_dir, logger,
+            bench_setts['run_dataExtractor'], bench_setts['run_preprocessor'],
+            bench_setts['run_kissICP'], bench_setts['run_trajectoryTransformer'],
+            bench_setts['run_mapGenerator'], bench_setts['run_laneMarker'],
+            False, bench_setts['max_workers']
+        )
+        logger.info(f'{length} m drive took {time.time() - start_time:.2f} seconds.')
+
+        if bench_setts['run_dataExtractor'] and bench_setts['run_kissICP']:
+            path_length, drive_distance = odometry_path(setts, output_dir)
+            if path_length < bench_setts['min_odometry_ratio'] * drive_distance:
+                logger.error(f'Odometry path of {path_length:.2f} m is far below the GNSS drive distance of '
+                             f'{drive_distance:.2f} m, the scene is degenerate for registration and the '
+                             f'timings are meaningless')
+                exit(1)
+
+        with open(os.path.join(output_dir, REPORT_FILE), 'r') as file:
+            results.append(summarize(length, json.load(file)))
+
+    print_summary(results)
+    benchmark_file = os.path.join(work_dir, BENCHMARK_FILE)
+    with open(benchmark_file, 'w') as file:
+        json.dump({'settings': bench_setts, 'results': results}, file, indent=4)
+    logger.info(f'Benchmark report saved at {benchmark_file}')
@@ -1,4 +1,5 @@
-import time
+import os
+import yaml
 from Scripts.distance_computer import DistanceComputer
 from Scripts.trajectory_transformer import TrajectoryTransformer
 from Scripts.lidar_odometry import RunKissICP
@@ -6,61 +7,141 @@ from Scripts.extractor import Extractor
 from Scripts.preprocessor import Preprocessor
 from Scripts.map_generator import MapGenerator
 from Scripts.lane_marker import LaneMarker
+from Utils.stage_cache import StageCache
+from Utils.task_graph import TaskGraph
+from Utils.perf_report import PerfReport
 
 
 class LaunchSequence:
     def __init__(self, bag_file, output_dir, logger,
                  run_dataExtractor, run_preprocessor,
                  run_kissICP, run_trajectoryTransformer,
-                 run_mapGenerator, run_laneMarker):
+                 run_mapGenerator, run_laneMarker,
+                 use_stage_cache=False, max_workers=1):
+        self.bag_file = bag_file
+        self.output_dir = output_dir
+        self.logger = logger
+        self.use_stage_cache = use_stage_cache
+        # Stages added to this launch, their outputs are regenerated before anything downstream reads them
+        self.running = set()
+
+        with open('Params/params.yaml', 'r') as parameters:
+            try:
+                params = yaml.safe_load(parameters)
+            except yaml.YAMLError as exc:
+                print(f"Error reading YAML file: {exc}")
+
+        with open('Config/settings.yaml', 'r') as settings:
+            try:
+                setts = yaml.safe_load(settings)
+            except yaml.YAMLError as exc:
+                print(f"Error reading YAML file: {exc}")
+
+        # Stages are recorded even when the cache is off, so a later cached launch knows what is on disk
+        self.cache = StageCache(output_dir, bag_file, params, setts, run_preprocessor,
+                                DistanceComputer(bag_file, output_dir).load_summary)
+
+        # Stages are split into tasks that only wait for the outputs they actually read, so plots,
+        # histograms and lane marking extraction overlap with the rest of the run
+        self.graph = TaskGraph(max_workers, logger)
+
+        if run_dataExtractor and not self.is_cached('Extractor'):
+            self.graph.add('Extractor', self.run_extractor)
+            self.add_record('Extractor', ['Extractor'])
+        else:
+            self.graph.add('DistanceComputer', self.run_distance_computer)
+
+        if run_preprocessor and not self.is_cached('Preprocessor'):
+            self.graph.add('Preprocessor', lambda: Preprocessor(output_dir, self.distance()).run(),
+                           ['Extractor', 'DistanceComputer'])
+            self.add_record('Preprocessor', ['Preprocessor'])
+
+        if run_kissICP and not self.is_cached('LidarOdometry'):
+            self.graph.add('LidarOdometry', lambda: RunKissICP(output_dir, run_preprocessor).run(),
+                           ['Preprocessor', 'Extractor'])
+            self.add_record('LidarOdometry', ['LidarOdometry'])
+
+        if run_trajectoryTransformer and not self.is_cached('TrajectoryTransformer'):
+            self.graph.add('TrajectoryTransformer.transform', self.run_trajectory_transformer,
+                           ['LidarOdometry', 'Extractor'])
+            self.graph.add('TrajectoryTransformer.plots', self.write_trajectory_plots,
+                           ['TrajectoryTransformer.transform'])
+            self.add_record('TrajectoryTransformer', ['TrajectoryTransformer.transform', 'TrajectoryTransformer.plots'])
 
-        start_time = time.time()
-        logger.info('Estimating Drive Distance...')
-        dstComputer = DistanceComputer(bag_file)
-        distance = dstComputer.compute_distance()
-        print(f"\033[93mTotal GPS estimated drive distance is {distance} meters.\033[0m")
-        elapsed_time = time.time() - start_time
-        logger.info(f'DistanceComputer module took {elapsed_time:.2f} seconds.\n')
-
-        if run_dataExtractor:
-            start_time = time.time()
-            logger.info('Running Extractor module...')
-            dataExtractor = Extractor(bag_file, output_dir)
-            dataExtractor.run()
-            elapsed_time = time.time() - start_time
-            logger.info(f'Extractor module took {elapsed_time:.2f} seconds.\n')
-        if run_preprocessor:
-            start_time = time.time()
-            logger.info('Running Preprocessor module...')
-            preProcessor = Preprocessor(output_dir, distance)
-            preProcessor.run()
-            elapsed_time = time.time() - start_time
-            logger.info(f'Preprocessor module took {elapsed_time:.2f} seconds.\n')
-        if run_kissICP:
-            start_time = time.time()
-            logger.info('Running RunKissICP module...')
-            kissicp = RunKissICP(output_dir, run_preprocessor)
-            kissicp.run()
-            elapsed_time = time.time() - start_time
-            logger.info(f'RunKissICP module took {elapsed_time:.2f} seconds.\n')
-        if run_trajectoryTransformer:
-            start_time = time.time()
-            logger.info('Running TrajectoryTransformer module...')
-            trajectoryTransformer = TrajectoryTransformer(output_dir)
-            trajectoryTransformer.run()
-            elapsed_time = time.time() - start_time
-            logger.info(f'TrajectoryTransformer module took {elapsed_time:.2f} seconds.\n')
         if run_mapGenerator:
-            start_time = time.time()
-            logger.info('Running MapGenerator module...')
             mapGen = MapGenerator(output_dir, run_preprocessor)
-            mapGen.run()
-            elapsed_time = time.time() - start_time
-            logger.info(f'MapGenerator module took {elapsed_time:.2f} seconds.\n')
-        if run_laneMarker:
-            start_time = time.time()
-            logger.info('Running LaneMarker module...')
-            laneMark = LaneMarker(output_dir)
-            laneMark.run()
-            elapsed_time = time.time() - start_time
-            logger.info(f'LaneMarker module took {elapsed_time:.2f} seconds.\n')
+            if not self.is_cached('MapGenerator'):
+                self.graph.add('MapGenerator', mapGen.build_maps,
+                               ['TrajectoryTransformer.transform', 'Preprocessor', 'Extractor'])
+                self.add_record('MapGenerator', ['MapGenerator'])
+            # Tiling only reads the finished maps, it overlaps with lane marking. Cached on its own,
+            # a new tile size does not rebuild the maps
+            if mapGen.tiles and not self.is_cached('MapTiles'):
+                self.graph.add('MapGenerator.tiles', mapGen.build_tiles,
+                               ['MapGenerator', 'TrajectoryTransformer.transform'])
+                self.add_record('MapTiles', ['MapGenerator.tiles'])
+
+        if run_laneMarker and not self.is_cached('LaneMarker'):
+            self.graph.add('LaneMarker.load', self.load_lane_marker,
+                           ['MapGenerator', 'TrajectoryTransformer.transform'])
+            tasks = ['LaneMarker.load',
+                     self.graph.add('LaneMarker.markings', self.extract_lane_markings, ['LaneMarker.load']),
+                     self.graph.add('LaneMarker.histogram', self.write_lane_histogram, ['LaneMarker.load'])]
+            self.add_record('LaneMarker', tasks)
+
+        PerfReport.reset()
+        try:
+            self.graph.run()
+        finally:
+            report_file = PerfReport.write(output_dir, bag_file=os.path.abspath(bag_file), max_workers=max_workers)
+            logger.info(f'Performance report saved at {report_file}')
+
+    def distance(self):
+        return self.graph.results.get('Extractor', self.graph.results.get('DistanceComputer'))
+
+    def run_extractor(self):
+        dataExtractor = Extractor(self.bag_file, self.output_dir)
+        dataExtractor.run()
+        print(f"\033[93mTotal GPS estimated drive distance is {dataExtractor.distance} meters.\033[0m")
+        return dataExtractor.distance
+
+    def run_distance_computer(self):
+        distance = DistanceComputer(self.bag_file, self.output_dir).get_distance()
+        print(f"\033[93mTotal GPS estimated drive distance is {distance} meters.\033[0m")
+        return distance
+
+    def run_trajectory_transformer(self):
+        # Poses handed over in memory when odometry ran in this launch
+        trajectoryTransformer = TrajectoryTransformer(self.output_dir, self.graph.results.get('LidarOdometry'))
+        TF_POSES, set1, set2, CONV_offset = trajectoryTransformer.apply_transformation()
+        trajectoryTransformer.write_poses(TF_POSES, CONV_offset)
+        return trajectoryTransformer, set1, set2
+
+    def write_trajectory_plots(self):
+        trajectoryTransformer, set1, set2 = self.graph.results['TrajectoryTransformer.transform']
+        trajectoryTransformer.write_plots(set1, set2)
+
+    def load_lane_marker(self):
+        laneMark = LaneMarker(self.output_dir)
+        return laneMark, laneMark.load_map()
+
+    def extract_lane_markings(self):
+        laneMark, cloud = self.graph.results['LaneMarker.load']
+        laneMark.extract_markings(cloud)
+
+    def write_lane_histogram(self):
+        laneMark, cloud = self.graph.results['LaneMarker.load']
+        if laneMark.plot_histogram:
+            laneMark.write_histogram(cloud)
+
+    def is_cached(self, stage):
+        if self.use_stage_cache and self.cache.is_fresh(stage, self.running):
+            self.logger.info(f'{stage} outputs are up to date, skipping.\n')
+            return True
+        self.cache.invalidate(stage)
+        self.running.add(stage)
+        return False
+
+    def add_record(self, stage, tasks):
+        # A stage is recorded in the cache once every one of its tasks has finished
+        self.graph.add(f'{stage}.record', lambda: self.cache.record(stage), tasks, log=False)
@@ -45,6 +45,8 @@ if __name__ == '__main__':
     run_trajectoryTransformer = ext_setts['run_trajectoryTransformer']
     run_mapGenerator = ext_setts['run_mapGenerator']
     run_laneMarker = ext_setts['run_laneMarker']
+    use_stage_cache = ext_setts['use_stage_cache']
+    max_workers = ext_setts['max_workers']
 
     COLOR = "\033[95m"
     RESET = "\033[0m"
@@ -58,7 +60,8 @@ if __name__ == '__main__':
         bag_file, output_dir, logging,
         run_dataExtractor, run_preprocessor,
         run_kissICP, run_trajectoryTransformer,
-        run_mapGenerator, run_laneMarker
+        run_mapGenerator, run_laneMarker,
+        use_stage_cache, max_workers
     )
 
     elapsed_time = time.time() - start_time